@@ -126,6 +126,7 @@ setup(
     extras_require=dict(
         test=[],
         app=[],
+        pack=['psycopg2'],
     ),
     entry_points={
         'console_scripts': [
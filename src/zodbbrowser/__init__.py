@@ -4,6 +4,7 @@ ZODB Browser has the following submodules:
   diff         -- compute differences between two dictionaries
   testing      -- doodads to make writing tests easier
   cache        -- caching logic
+  tidindex     -- on-disk index of transaction positions in a FileStorage
 
   history      -- extracts historical state information from the ZODB
   state        -- IStateInterpreter adapters for making sense of unpickled data
@@ -1,5 +1,7 @@
 import time
+import itertools
 import logging
+import threading
 from cgi import escape
 
 from zope.app.pagetemplate.viewpagetemplatefile import ViewPageTemplateFile
@@ -23,13 +25,17 @@ import transaction
 
 
 from zodbbrowser import __homepage__
+from zodbbrowser import cache
 from zodbbrowser.history import ZodbObjectHistory
-from zodbbrowser.interfaces import IValueRenderer
+from zodbbrowser.history import ObjectHistoryCache, historyCache
+from zodbbrowser.history import prefetchStates
+from zodbbrowser.interfaces import IValueRenderer, HistoryMissingError
 from zodbbrowser.interfaces import IDatabaseHistory
 from zodbbrowser.interfaces import IReferencesDatabase
 from zodbbrowser.state import ZodbObjectState
 from zodbbrowser.diff import compareDictsHTML
 from zodbbrowser.value import pruneTruncations, TRUNCATIONS
+from zodbbrowser.value import hasExpiredTruncations, findPersistentValues
 
 
 log = logging.getLogger("zodbbrowser")
@@ -44,6 +50,58 @@ class ZodbHelpView(BrowserView):
     homepage = __homepage__
 
 
+_thread_connections = threading.local()
+# every connection handed out by getThreadConnection, so that they can all
+# be closed when the server shuts down
+_open_thread_connections = set()
+_open_thread_connections_lock = threading.Lock()
+
+
+def getThreadConnection(db):
+    """Return a connection to db that stays open in the current thread.
+
+    The standalone server has a fixed set of worker threads, and reusing the
+    same connection keeps its object cache warm from request to request.
+    The connection is registered with the thread's transaction manager, so
+    it catches up with newer transactions whenever a request begins.
+    """
+    conn = getattr(_thread_connections, 'conn', None)
+    if conn is not None and conn.opened and conn.db() is db:
+        return conn
+    closeThreadConnection()
+    conn = _thread_connections.conn = db.open()
+    with _open_thread_connections_lock:
+        _open_thread_connections.add(conn)
+    return conn
+
+
+def closeThreadConnection():
+    """Close the connection opened by getThreadConnection, if any."""
+    conn = getattr(_thread_connections, 'conn', None)
+    _thread_connections.conn = None
+    if conn is not None:
+        _closeThreadConnection(conn)
+
+
+def closeAllThreadConnections():
+    """Close the connections opened by getThreadConnection in all threads."""
+    with _open_thread_connections_lock:
+        connections = list(_open_thread_connections)
+    for conn in connections:
+        _closeThreadConnection(conn)
+
+
+def _closeThreadConnection(conn):
+    with _open_thread_connections_lock:
+        _open_thread_connections.discard(conn)
+    if conn.opened:
+        try:
+            conn.close()
+        except Exception:
+            # e.g. the database was closed already
+            log.debug('Could not close connection %r', conn, exc_info=True)
+
+
 class ZodbObjectAttribute(object):
 
     def __init__(self, name, value, tid=None):
@@ -77,6 +135,7 @@ class VeryCarefulView(BrowserView):
     homepage = __homepage__
     made_changes = False
     state = None
+    pin_to_tid = False
 
     @Lazy
     def references(self):
@@ -94,13 +153,17 @@ class VeryCarefulView(BrowserView):
             return True
         return support()
 
+    @Lazy
+    def history_cache(self):
+        return ObjectHistoryCache()
+
     @Lazy
     def jar(self):
         db = queryUtility(IDatabase, name='<target>')
         if db is not None:
-            conn = db.open()
-            self.request.hold(Cleanup(conn.close))
-            return conn
+            if self.pinnedTid is None:
+                return getThreadConnection(db)
+            return self._openConnection(db, at=self.pinnedTid)
         try:
             return self.request.annotations['ZODB.interfaces.IConnection']
         except (KeyError, AttributeError):
@@ -109,8 +172,35 @@ class VeryCarefulView(BrowserView):
                 raise Exception("ZODB connection not available for this request")
             return obj._p_jar
 
+    @Lazy
+    def pinnedTid(self):
+        """The tid to open a historical connection at, or None.
+
+        Historical connections load every object as of that transaction
+        through the regular object cache, and ZODB pools them by tid, so
+        subsequent requests for the same tid come cheap.  They're only
+        available in standalone mode (where we open our own connections),
+        and views must opt in by setting pin_to_tid.  Rollbacks need a
+        writable connection.
+        """
+        if not self.pin_to_tid or 'ROLLBACK' in self.request:
+            return None
+        try:
+            return p64(int(self.request.get('tid'), 0))
+        except (TypeError, ValueError):
+            return None
+
+    def _openConnection(self, db, at=None):
+        conn = db.open(at=at)
+        self.request.hold(Cleanup(conn.close))
+        return conn
+
     @Lazy
     def readonly(self):
+        if getattr(self.jar, 'before', None) is not None:
+            # historical connections are always read-only, but rollbacks
+            # use a regular one
+            return self.jar.db().storage.isReadOnly()
         return self.jar.isReadOnly()
 
     def findObjectFromOID(self, oid, tid=None):
@@ -118,6 +208,13 @@ class VeryCarefulView(BrowserView):
         try:
             return self.jar.get(p_oid)
         except POSKeyError as error:
+            if getattr(self.jar, 'before', None) is not None:
+                # The object did not exist yet at the requested tid.  Show
+                # it anyway, the history will explain what happened.
+                try:
+                    return self._openConnection(self.jar.db()).get(p_oid)
+                except POSKeyError:
+                    pass
             if self.references is not None:
                 for referred in self.references.getBackwardReferences(p_oid):
                     try:
@@ -152,7 +249,8 @@ class VeryCarefulView(BrowserView):
 
     def __call__(self):
         try:
-            return self.render()
+            with historyCache(self.history_cache):
+                return self.render()
         finally:
             if self.readonly or not self.made_changes:
                 resources = transaction.get()._resources
@@ -196,9 +294,13 @@ class ZodbInfoView(VeryCarefulView):
     template = ViewPageTemplateFile('templates/zodbinfo.pt')
     confirmation_template = ViewPageTemplateFile('templates/confirm_rollback.pt')
 
-    def render(self):
-        self._started = time.time()
-        pruneTruncations()
+    history_template = ViewPageTemplateFile('templates/zodbinfo_history.pt')
+    diff_template = ViewPageTemplateFile('templates/zodbinfo_diff.pt')
+    history_page_size = 20
+    history_diffs_expanded = 5
+    pin_to_tid = True
+
+    def _loadObject(self):
         self.obj = self.selectObjectToView()
         # Not using IObjectHistory(self.obj) because LP#1185175
         self.history = ZodbObjectHistory(self.obj)
@@ -211,6 +313,36 @@ class ZodbInfoView(VeryCarefulView):
             self.latest = self.state.tid is None
         else:
             self.state = ZodbObjectState(self.obj, _history=self.history)
+        self.history_size = self.history_page_size
+        if 'history_size' in self.request:
+            self.history_size = max(1, parseInt(self.request['history_size'],
+                                                'history_size'))
+        if not self.latest:
+            # make sure the revision we're looking at is listed
+            self.history_size = max(self.history_size,
+                                    self._positionInHistory(self.state.tid) + 1)
+
+    def _positionInHistory(self, tid):
+        """Find the position of the revision tid in the object's history.
+
+        Looks at the latest revisions first, so that the whole history is
+        loaded only if we're looking at an old one.  Returns -1 if there's
+        no such revision.
+        """
+        size = self.history_size
+        while True:
+            records = self.history.slice(0, size)
+            for n, d in enumerate(records):
+                if d['tid'] == tid:
+                    return n
+            if len(records) < size:
+                return -1
+            size *= 2
+
+    def render(self):
+        self._started = time.time()
+        pruneTruncations()
+        self._loadObject()
 
         if 'CANCEL' in self.request:
             self._redirectToSelf()
@@ -328,6 +460,28 @@ class ZodbInfoView(VeryCarefulView):
     def truncated_ajax(self, id): # AJAX view
         return TRUNCATIONS.get(id)
 
+    def history_ajax(self, start, stop): # AJAX view
+        with historyCache(self.history_cache):
+            try:
+                self._loadObject()
+                return self.renderHistory(parseInt(start, 'start'),
+                                          parseInt(stop, 'stop'))
+            finally:
+                transaction.abort()
+
+    def diff_ajax(self, tid): # AJAX view
+        with historyCache(self.history_cache):
+            try:
+                self.obj = self.selectObjectToView()
+                self.history = ZodbObjectHistory(self.obj)
+                tid = parseInt(tid, 'tid', 0)
+                if not 1 <= tid < 2 ** 64:
+                    raise UserError('tid out of range: 0x%x' % tid)
+                error, diff = self.getDiff(p64(tid))
+                return self.diff_template(error=error, diff=diff)
+            finally:
+                transaction.abort()
+
     def locate(self, path):
         not_found = object() # marker
 
@@ -400,30 +554,30 @@ class ZodbInfoView(VeryCarefulView):
 
     def getBreadcrumbs(self):
         breadcrumbs = []
-        state = self.state
         seen_root = False
-        while True:
-            url = self.getUrl(state.getObjectId())
-            if state.isRoot():
+        tid = self.state.requestedTid
+        paths = getAncestryCache(self.jar, tid)
+        for oid, is_root, name, has_parent in getAncestry(self.state, tid,
+                                                          paths):
+            url = self.getUrl(oid)
+            if is_root:
                 breadcrumbs.append(('/', url))
                 seen_root = True
             else:
                 if breadcrumbs:
                     breadcrumbs.append(('/', None))
-                if not state.getName() and state.getParentState() is None:
+                if not name and not has_parent:
                     # not using hex() because we don't want L suffixes for
                     # 64-bit values
-                    breadcrumbs.append(('0x%x' % state.getObjectId(), url))
+                    breadcrumbs.append(('0x%x' % oid, url))
                     break
-                breadcrumbs.append((state.getName() or '???', url))
-            state = state.getParentState()
-            if state is None:
-                if not seen_root:
-                    url = self.getUrl(self.getRootOid())
-                    breadcrumbs.append(('/', None))
-                    breadcrumbs.append(('...', None))
-                    breadcrumbs.append(('/', url))
-                break
+                breadcrumbs.append((name or '???', url))
+        else:
+            if not seen_root:
+                url = self.getUrl(self.getRootOid())
+                breadcrumbs.append(('/', None))
+                breadcrumbs.append(('...', None))
+                breadcrumbs.append(('/', url))
         return breadcrumbs[::-1]
 
     def getPath(self):
@@ -439,10 +593,19 @@ class ZodbInfoView(VeryCarefulView):
                 html.append(escape(name))
         return ''.join(html)
 
+    def _prefetch(self, pairs):
+        # PersistentValue renders linked objects as of the requested tid,
+        # which would otherwise take a couple of storage calls per object
+        if self.state.requestedTid is not None:
+            values = [value for name, value in pairs]
+            prefetchStates(findPersistentValues(values),
+                           self.state.requestedTid)
+
     def listAttributes(self):
         attrs = self.state.listAttributes()
         if attrs is None:
             return None
+        self._prefetch(attrs)
         return [ZodbObjectAttribute(name, value, self.state.requestedTid)
                 for name, value in sorted(attrs)]
 
@@ -450,29 +613,62 @@ class ZodbInfoView(VeryCarefulView):
         items = self.state.listItems()
         if items is None:
             return None
+        self._prefetch(items)
         return [ZodbObjectAttribute(name, value, self.state.requestedTid)
                 for name, value in items]
 
-    def _loadHistoricalState(self):
-        results = []
-        for d in self.history:
-            try:
-                interp = ZodbObjectState(self.obj, d['tid'],
-                                         _history=self.history)
-                state = interp.asDict()
-                error = interp.getError()
-            except Exception, e:
-                state = {}
-                error = '%s: %s' % (e.__class__.__name__, e)
-            results.append(dict(state=state, error=error))
-        results.append(dict(state={}, error=None))
-        return results
-
-    def listHistory(self):
-        """List transactions that modified a persistent object."""
-        state = self._loadHistoricalState()
+    def _loadRevision(self, tid):
+        try:
+            interp = ZodbObjectState(self.obj, tid, _history=self.history)
+            return interp.asDict(), interp.getError()
+        except Exception, e:
+            return {}, '%s: %s' % (e.__class__.__name__, e)
+
+    def getDiff(self, tid):
+        """Compare the revision from transaction tid with the previous one.
+
+        Returns a tuple (error, diff), where error is an error message (or
+        None) and diff is HTML.  Results are cached, since old revisions
+        never change.
+        """
+        try:
+            old_tid = self.history.lastChange(p64(u64(tid) - 1))
+        except HistoryMissingError:
+            # the object was created in tid (or its history was packed)
+            old_tid = None
+        key = (self.obj._p_oid, tid, old_tid)
+        diffs = cache.getDiffCache(self.obj._p_jar.db().storage)
+        result = diffs.get(key)
+        if result is None or hasExpiredTruncations(result[1]):
+            state, error = self._loadRevision(tid)
+            if old_tid is None:
+                old_state = {}
+            else:
+                old_state = self._loadRevision(old_tid)[0]
+            link_tid = None
+            if self.supportsUndo:
+                link_tid = tid
+            result = error, compareDictsHTML(state, old_state, link_tid)
+            diffs[key] = result
+        return result
+
+    def listHistory(self, start=0, stop=None):
+        """List transactions that modified a persistent object.
+
+        Lists only history records from start to stop (latest first), since
+        unpickling and comparing every revision of a busy object takes ages.
+        Only the latest few revisions are compared right away, the rest are
+        compared on demand by diff_ajax.
+        """
+        if stop is None:
+            stop = self.history_size
+        records = self.history.slice(start, stop)
+        # the revisions are numbered from the oldest one if we know how
+        # many of them there are, otherwise back from the latest one, which
+        # is #-1
+        total = self.history.knownLength()
         results = []
-        for n, d in enumerate(self.history):
+        for n, d in enumerate(records):
             utc_timestamp = str(time.strftime('%Y-%m-%d %H:%M:%S',
                                               time.gmtime(d['time'])))
             local_timestamp = str(time.strftime('%Y-%m-%d %H:%M:%S',
@@ -482,29 +678,53 @@ class ZodbInfoView(VeryCarefulView):
             except ValueError:
                 user_location = None
                 user_id = d['user_name']
-            url = self.getUrl(tid=u64(d['tid']))
+            utid = u64(d['tid'])
+            url = self.getUrl(tid=utid)
             current = (d['tid'] == self.state.tid and
                        self.state.requestedTid is not None)
-            curState = state[n]['state']
-            oldState = state[n + 1]['state']
-            tid = None
-            if self.supportsUndo:
-                tid = d['tid']
-            diff = compareDictsHTML(curState, oldState, tid)
+            if start + n < self.history_diffs_expanded:
+                error, diff = self.getDiff(d['tid'])
+            else:
+                error = diff = None
+            diff_url = '@@zodbbrowser_diff?oid=0x%x&tid=0x%x' % (
+                u64(self.obj._p_oid), utid)
 
-            results.append(dict(utid=u64(d['tid']),
+            results.append(dict(utid=utid,
                                 href=url, current=current,
-                                error=state[n]['error'],
-                                diff=diff, user_id=user_id,
+                                error=error, diff=diff, diff_url=diff_url,
+                                user_id=user_id,
                                 user_location=user_location,
                                 utc_timestamp=utc_timestamp,
                                 local_timestamp=local_timestamp, **d))
+            # number in reverse order
+            if total is not None:
+                results[-1]['index'] = total - start - n
+            else:
+                results[-1]['index'] = -(start + n + 1)
+            results[-1]['latest'] = (start + n == 0)
+        return results
 
-        # number in reverse order
-        for i in range(len(results)):
-            results[i]['index'] = len(results) - i
+    def getMoreHistory(self, stop):
+        """Return links for loading history records after stop.
 
-        return results
+        Returns None if there are no more records.  When the history has
+        not been loaded in full, we can only tell that there may be more.
+        """
+        if (len(self.history.slice(0, stop)) < stop or
+                self.history.knownLength() == stop):
+            return None
+        url = self.getUrl()
+        return dict(
+            href='%s&history_size=%d' % (url, stop + self.history_page_size),
+            ajax_url='%s&start=%d&stop=%d' % (
+                url.replace('@@zodbbrowser?', '@@zodbbrowser_history_ajax?'),
+                stop, stop + self.history_page_size))
+
+    def renderHistory(self, start=0, stop=None):
+        if stop is None:
+            stop = self.history_size
+        return self.history_template(history=self.listHistory(start, stop),
+                                     more=self.getMoreHistory(stop))
 
     def _tidToTimestamp(self, tid):
         if isinstance(tid, str) and len(tid) == 8:
@@ -518,7 +738,10 @@ class ZodbHistoryView(VeryCarefulView):
     adapts(Interface, IBrowserRequest)
 
     template = ViewPageTemplateFile('templates/zodbhistory.pt')
+    objects_template = ViewPageTemplateFile('templates/zodbhistory_objects.pt')
     page_size = 5
+    inline_objects = 5
+    objects_page_size = 100
 
     def render(self):
         self._started = time.time()
@@ -553,14 +776,74 @@ class ZodbHistoryView(VeryCarefulView):
         return url
 
     def findPage(self, tid):
+        tid = self.history.tidAtOrBefore(tid)
+        if tid is None:
+            return 0
+        pos = self.history.positionOf(tid)
+        return (len(self.history) - pos - 1) // self.page_size
+
+    def _getTransaction(self, tid):
         try:
-            pos = list(self.history.tids).index(tid)
+            pos = self.history.positionOf(tid)
         except ValueError:
-            return 0
-        else:
-            return (len(self.history) - pos - 1) // self.page_size
+            raise UserError('There is no transaction %s' % tid_repr(tid))
+        for d in self.history[pos:pos + 1]:
+            return d
+        # e.g. the storage was packed since we looked at it
+        raise UserError('There is no transaction %s' % tid_repr(tid))
+
+    def getObjectsUrl(self, tid, start=0):
+        return '@@zodbbrowser_transaction_objects?tid=0x%x&start=%d' % (
+            u64(tid), start)
+
+    def listObjects(self, tid, oids):
+        """Describe the objects saved in a transaction."""
+        utid = u64(tid)
+        objects = []
+        for oid in oids:
+            obj = self.jar.get(oid)
+            url = "@@zodbbrowser?oid=0x%x&tid=0x%x" % (u64(oid), utid)
+            objects.append(dict(
+                oid=u64(oid),
+                path=getObjectPath(obj, tid),
+                oid_repr=oid_repr(oid),
+                class_repr=getObjectType(obj),
+                url=url,
+                repr=IValueRenderer(obj).render(tid),
+            ))
+        return objects
+
+    def objects_ajax(self, tid, start='0'): # AJAX view
+        """Render a batch of objects saved in a transaction."""
+        with historyCache(self.history_cache):
+            try:
+                self.history = IDatabaseHistory(self.jar)
+                try:
+                    tid = p64(int(tid, 0))
+                except ValueError:
+                    raise UserError('TID is not an integer: %r' % tid)
+                start = parseInt(start, 'start')
+                stop = start + self.objects_page_size
+                d = self._getTransaction(tid)
+                # one extra to see if there are any more
+                oids = [record.oid for record in
+                        itertools.islice(d, start, stop + 1)]
+                more_url = None
+                if len(oids) > self.objects_page_size:
+                    del oids[self.objects_page_size:]
+                    more_url = self.getObjectsUrl(tid, stop)
+                return self.objects_template(
+                    objects=self.listObjects(tid, oids), more_url=more_url)
+            finally:
+                transaction.abort()
 
     def listHistory(self):
+        """List transactions on the current page.
+
+        Looking at the objects saved in a transaction is expensive, so we
+        only do that for small transactions; objects of the larger ones are
+        listed by objects_ajax when the user expands the transaction.
+        """
         if 'tid' in self.request:
             requested_tid = p64(int(self.request['tid'], 0))
         else:
@@ -582,23 +865,15 @@ class ZodbHistoryView(VeryCarefulView):
             except AttributeError:
                 size = None
             ext = d.extension if isinstance(d.extension, dict) else {}
-            objects = []
-            for record in d:
-                obj = self.jar.get(record.oid)
-                url = "@@zodbbrowser?oid=0x%x&tid=0x%x" % (u64(record.oid),
-                                                           utid)
-                objects.append(dict(
-                    oid=u64(record.oid),
-                    path=getObjectPath(obj, d.tid),
-                    oid_repr=oid_repr(record.oid),
-                    class_repr=getObjectType(obj),
-                    url=url,
-                    repr=IValueRenderer(obj).render(d.tid),
-                ))
-            if len(objects) == 1:
+            oids = [record.oid for record in d]
+            hidden = len(oids) > self.inline_objects
+            objects = None
+            if not hidden:
+                objects = self.listObjects(d.tid, oids)
+            if len(oids) == 1:
                 summary = '1 object record'
             else:
-                summary = '%d object records' % len(objects)
+                summary = '%d object records' % len(oids)
             if size is not None:
                 summary += ' (%d bytes)' % size
             results.append(dict(
@@ -613,8 +888,9 @@ class ZodbHistoryView(VeryCarefulView):
                 href=self.getUrl(tid=utid),
                 size=size,
                 summary=summary,
-                hidden=(len(objects) > 5),
+                hidden=hidden,
                 objects=objects,
+                objects_url=self.getObjectsUrl(d.tid),
                 **ext
             ))
         if results and not requested_tid and self.page == 0:
@@ -622,6 +898,19 @@ class ZodbHistoryView(VeryCarefulView):
         return results[::-1]
 
 
+def parseInt(value, name, base=10):
+    """Convert a number passed in the request to an int.
+
+    Raises UserError for junk.  Pass base=0 to accept 0x1234 too.
+    """
+    try:
+        if base == 10:
+            return int(value)
+        return int(value, base)
+    except (TypeError, ValueError):
+        raise UserError('%s is not an integer: %r' % (name, value))
+
+
 def getObjectType(obj):
     cls = getattr(obj, '__class__', None)
     if type(obj) is not cls:
@@ -638,28 +927,76 @@ def getObjectTypeShort(obj):
         return cls.__name__
 
 
+def getAncestryCache(jar, tid):
+    """Return the cache of ancestries to use for a database as of tid.
+
+    Returns None if we cannot cache anything.  That's the case for the
+    latest state (tid=None): what it is depends on which transactions the
+    connection has seen, so it cannot be keyed by a tid.
+    """
+    if jar is None or tid is None:
+        return None
+    return cache.getPathCache(jar.db().storage)
+
+
+def getAncestry(state, tid=None, paths=None):
+    """Describe an object and its ancestors, following __parent__ links.
+
+    Returns a tuple of (oid, is_root, name, has_parent) tuples, starting
+    with the object described by state (an IStateInterpreter).
+
+    Finding the parent of an object means loading its state, so if paths
+    (a cache keyed by (oid, tid)) is given, the ancestries of all objects
+    visited are remembered there, and those of their parents are reused.
+    """
+    ancestry = []
+    tail = ()
+    while True:
+        oid = state.getObjectId()
+        parent = state.getParent()
+        ancestry.append((oid, state.isRoot(), state.getName(),
+                         parent is not None))
+        if parent is None:
+            break
+        parent_oid = getattr(parent, '_p_oid', None)
+        if paths is not None and parent_oid is not None:
+            tail = paths.get((u64(parent_oid), tid))
+            if tail is not None:
+                break
+            tail = ()
+        state = state.getParentState()
+    ancestry = tuple(ancestry) + tail
+    if paths is not None:
+        for n in range(len(ancestry) - len(tail)):
+            paths[ancestry[n][0], tid] = ancestry[n:]
+    return ancestry
+
+
 def getObjectPath(obj, tid):
     path = []
     seen_root = False
-    state = ZodbObjectState(obj, tid)
-    while True:
-        if state.isRoot():
+    paths = getAncestryCache(obj._p_jar, tid)
+    ancestry = None
+    if paths is not None:
+        ancestry = paths.get((u64(obj._p_oid), tid))
+    if ancestry is None:
+        ancestry = getAncestry(ZodbObjectState(obj, tid), tid, paths)
+    for oid, is_root, name, has_parent in ancestry:
+        if is_root:
             path.append('/')
             seen_root = True
         else:
             if path:
                 path.append('/')
-            if not state.getName() and state.getParentState() is None:
+            if not name and not has_parent:
                 # not using hex() because we don't want L suffixes for
                 # 64-bit values
-                path.append('0x%x' % state.getObjectId())
+                path.append('0x%x' % oid)
                 break
-            path.append(state.getName() or '???')
-        state = state.getParentState()
-        if state is None:
-            if not seen_root:
-                path.append('/')
-                path.append('...')
-                path.append('/')
-            break
+            path.append(name or '???')
+    else:
+        if not seen_root:
+            path.append('/')
+            path.append('...')
+            path.append('/')
     return ''.join(path[::-1])
@@ -25,7 +25,7 @@ except ImportError:
     from zope.app.container.btree import BTreeContainer # BBB
 
 from zodbbrowser.interfaces import IStateInterpreter, IObjectHistory
-from zodbbrowser.history import ZodbObjectHistory
+from zodbbrowser.history import ZodbObjectHistory, getObjectHistory
 from zodbbrowser.state import GenericState
 
 
@@ -58,6 +58,20 @@ class OOBTreeHistory(ZodbObjectHistory):
         self._history.sort(key=lambda d: d['tid'], reverse=True)
         self._index_by_tid()
 
+    def slice(self, start, stop=None):
+        # the merged history cannot be loaded piecemeal
+        if self._history is None:
+            self._load()
+        return self._history[start:stop]
+
+    def _rememberRevision(self, tid, serial):
+        # lastChange must look at the merged history of all the buckets
+        pass
+
+    def _quickLastChange(self, tid):
+        # ditto
+        return None
+
     def _lastRealChange(self, tid=None):
         return ZodbObjectHistory(self._obj).lastChange(tid)
 
@@ -68,14 +82,13 @@ class OOBTreeHistory(ZodbObjectHistory):
         # XXX: this is used to show the pickled size of an object.  It
         # will be misleading for BTrees if we show just the size for the
         # main BTree object while we're hiding all the individual buckets.
-        return self._connection._storage.loadSerial(self._obj._p_oid,
-                                                    self._lastRealChange(tid))
+        return self._loadSerial(self._lastRealChange(tid))
 
     def loadState(self, tid=None):
         # lastChange would return the tid that modified self._obj or any
         # of its subobjects, thanks to the history merging done by _load.
         # We need the real last change value.
-        return self._connection.oldstate(self._obj, self._lastRealChange(tid))
+        return self._unpickleState(self._loadSerial(self._lastRealChange(tid)))
 
     def rollback(self, tid):
         state = self.loadState(tid)
@@ -85,7 +98,7 @@ class OOBTreeHistory(ZodbObjectHistory):
 
         while state and len(state) > 1:
             bucket = state[1]
-            bucket_history = IObjectHistory(bucket)
+            bucket_history = getObjectHistory(bucket)
             state = bucket_history.loadState(tid)
             if state != bucket_history.loadState():
                 bucket.__setstate__(state)
@@ -106,7 +119,7 @@ class OOBTreeState(object):
         # docs of the pickled state format.
         while state and len(state) > 1:
             bucket = state[1]
-            state = IObjectHistory(bucket).loadState(tid)
+            state = getObjectHistory(bucket).loadState(tid)
             # XXX this is dangerous!
             bucket.__setstate__(state)
 
@@ -118,7 +131,7 @@ class OOBTreeState(object):
         state = self.state
         while state and len(state) > 1:
             bucket = state[1]
-            state = IObjectHistory(bucket).loadState()
+            state = getObjectHistory(bucket).loadState()
             bucket.__setstate__(state)
 
     def getError(self):
@@ -155,7 +168,7 @@ class FolderState(GenericState):
         if not data:
             return []
         # data will be an OOBTree
-        loadedstate = IObjectHistory(data).loadState(self.tid)
+        loadedstate = getObjectHistory(data).loadState(self.tid)
         return getMultiAdapter((data, loadedstate, self.tid),
                                IStateInterpreter).listItems()
 
@@ -171,7 +184,7 @@ class BTreeContainerState(GenericState):
         if not data:
             return []
         # data will be an OOBTree
-        loadedstate = IObjectHistory(data).loadState(self.tid)
+        loadedstate = getObjectHistory(data).loadState(self.tid)
         return getMultiAdapter((data, loadedstate, self.tid),
                                IStateInterpreter).listItems()
 
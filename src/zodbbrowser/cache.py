@@ -2,13 +2,271 @@
 Ad-hoc caching, because uncached zodbbrowser is slow and sad.
 """
 
+import threading
 import time
 import weakref
+from collections import OrderedDict
+
+from ZODB.FileStorage.FileStorage import FileStorage
+from ZODB.POSException import POSKeyError
+from ZODB.utils import p64, u64
+
+from zodbbrowser.tidarray import TidArray
+from zodbbrowser.tidindex import TransactionIndex
 
 MINUTES = 60
 HOURS = 60 * MINUTES
 
+MEGABYTES = 1024 * 1024
+
 STORAGE_TIDS = weakref.WeakKeyDictionary()
+TRANSACTION_INDEXES = weakref.WeakKeyDictionary()
+HISTORY_RECORDS = weakref.WeakKeyDictionary()
+STATE_PICKLES = weakref.WeakKeyDictionary()
+DIFFS = weakref.WeakKeyDictionary()
+PATHS = weakref.WeakKeyDictionary()
+
+MAX_HISTORY_RECORDS = 1000 # objects per storage
+MAX_STATE_PICKLES_SIZE = 64 * MEGABYTES # per storage
+MAX_DIFFS_SIZE = 16 * MEGABYTES # per storage
+MAX_PATHS = 10000 # objects per storage
+
+_lock = threading.Lock()
+
+
+class LRUCache(object):
+    """Size-bounded mapping that evicts the least recently used items.
+
+    By default every item counts as 1 towards the size limit; pass a sizeof
+    function to weigh items differently (e.g. by their size in bytes).
+
+    Safe to share between threads.  Keeps hit and miss counters.
+    """
+
+    def __init__(self, size, sizeof=None):
+        self.size = size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value, size
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            self._pop(key)
+            if size > self.size:
+                # would evict everything else and still not fit
+                return
+            self._data[key] = value, size
+            self.used += size
+            while self.used > self.size:
+                self._pop(next(iter(self._data)))
+
+    def resize(self, size):
+        with self._lock:
+            self.size = size
+            while self.used > self.size:
+                self._pop(next(iter(self._data)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._pop(key, default)
+
+    def _pop(self, key, default=None):
+        try:
+            value, size = self._data.pop(key)
+        except KeyError:
+            return default
+        self.used -= size
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.used = 0
+
+
+class HistoryRecordCache(LRUCache):
+    """Cache of storage.history() results for one storage, keyed by oid.
+
+    Entries are invalidated by looking at the records of transactions
+    committed since storage.lastTransaction() was last checked.
+    """
+
+    def __init__(self, size, last_transaction):
+        LRUCache.__init__(self, size)
+        self.last_transaction = last_transaction
+        self._invalidation_lock = threading.Lock()
+
+    def invalidate(self, storage):
+        """Drop histories of objects modified since the last check."""
+        last_transaction = lastTransaction(storage)
+        if last_transaction == self.last_transaction:
+            return
+        with self._invalidation_lock:
+            if last_transaction == self.last_transaction:
+                return
+            start = p64(u64(self.last_transaction) + 1)
+            try:
+                for t in storage.iterator(start=start):
+                    for record in t:
+                        self.pop(record.oid)
+            except (AttributeError, NotImplementedError):
+                # can't tell what changed, so forget everything
+                self.clear()
+            self.last_transaction = last_transaction
+
+
+def getHistoryRecords(storage, oid, load):
+    """Return the history records of an object (see IStorage.history).
+
+    Calls load() to fetch them from the storage on a cache miss.  Storages
+    that do not support lastTransaction() are not cached, since we could not
+    tell when the records change.
+    """
+    last_transaction = lastTransaction(storage)
+    if last_transaction is None:
+        return load()
+    with _lock:
+        histories = HISTORY_RECORDS.get(storage)
+        if histories is None:
+            histories = HISTORY_RECORDS[storage] = HistoryRecordCache(
+                MAX_HISTORY_RECORDS, last_transaction)
+    histories.invalidate(storage)
+    history = histories.get(oid)
+    if history is None:
+        history = load()
+        histories[oid] = history
+    return history
+
+
+def getCachedHistoryRecords(storage, oid):
+    """Return the cached history records of an object, or None on a miss."""
+    if lastTransaction(storage) is None:
+        return None
+    with _lock:
+        histories = HISTORY_RECORDS.get(storage)
+    if histories is None:
+        return None
+    histories.invalidate(storage)
+    return histories.get(oid)
+
+
+def setStatePicklesCacheSize(size):
+    """Change the memory ceiling (in bytes) of the state pickle caches."""
+    global MAX_STATE_PICKLES_SIZE
+    MAX_STATE_PICKLES_SIZE = size
+    with _lock:
+        for pickles in STATE_PICKLES.values():
+            pickles.resize(size)
+
+
+def _statePickles(storage):
+    with _lock:
+        pickles = STATE_PICKLES.get(storage)
+        if pickles is None:
+            pickles = STATE_PICKLES[storage] = LRUCache(MAX_STATE_PICKLES_SIZE,
+                                                        sizeof=len)
+    return pickles
+
+
+def loadSerial(storage, oid, serial):
+    """Load the pickled state of an object revision.
+
+    Revisions never change, so they're kept in an LRU cache limited to
+    MAX_STATE_PICKLES_SIZE bytes.
+    """
+    pickles = _statePickles(storage)
+    data = pickles.get((oid, serial))
+    if data is None:
+        data = storage.loadSerial(oid, serial)
+        pickles[oid, serial] = data
+    return data
+
+
+def rememberSerial(storage, oid, serial, data):
+    """Put an object revision loaded by other means into the cache."""
+    _statePickles(storage)[oid, serial] = data
+
+
+def loadBefore(storage, oids, tid):
+    """Load the revisions of many objects that were current as of tid.
+
+    Returns a dict mapping oids to (data, serial) tuples.  Objects that did
+    not exist yet are left out.
+
+    Storages that support prefetching (ZEO 5) get the list of all oids up
+    front, so they can fetch them in one round-trip instead of one per
+    object.
+    """
+    before = p64(u64(tid) + 1)
+    try:
+        storage.prefetch(oids, before)
+    except (AttributeError, TypeError):
+        # no prefetching, or a storage that prefetches only current
+        # revisions
+        pass
+    results = {}
+    for oid in oids:
+        try:
+            result = storage.loadBefore(oid, before)
+        except POSKeyError:
+            continue
+        if result is not None:
+            data, serial, end = result
+            results[oid] = data, serial
+    return results
+
+
+def getDiffCache(storage):
+    """Return the cache of rendered differences between object revisions.
+
+    Keys are (oid, new_tid, old_tid) and values are (error, html) tuples.
+    Revisions never change, so neither do the differences between them.
+    The cache is limited to MAX_DIFFS_SIZE bytes of HTML.
+    """
+    with _lock:
+        diffs = DIFFS.get(storage)
+        if diffs is None:
+            diffs = DIFFS[storage] = LRUCache(MAX_DIFFS_SIZE,
+                                              sizeof=_diffSize)
+    return diffs
+
+
+def _diffSize(value):
+    error, html = value
+    return len(html)
+
+
+def getPathCache(storage):
+    """Return the cache of object ancestries, keyed by (oid, tid).
+
+    See zodbbrowser.browser.getAncestry.
+    """
+    with _lock:
+        paths = PATHS.get(storage)
+        if paths is None:
+            paths = PATHS[storage] = LRUCache(MAX_PATHS)
+    return paths
 
 
 def expired(cache_dict, cache_for):
@@ -17,27 +275,106 @@ def expired(cache_dict, cache_for):
     return time.time() > cache_dict['last_update'] + cache_for
 
 
+def getTransactionIndex(storage):
+    """Return the on-disk TransactionIndex for a storage.
+
+    Returns None for storages other than FileStorage.
+    """
+    if not isinstance(storage, FileStorage):
+        return None
+    with _lock:
+        index = TRANSACTION_INDEXES.get(storage)
+        if index is None:
+            index = TRANSACTION_INDEXES[storage] = TransactionIndex(storage)
+    return index
+
+
+def lastTransaction(storage):
+    try:
+        return storage.lastTransaction()
+    except AttributeError:
+        return None
+
+
+def upToDate(storage, cache_dict, cache_for):
+    if 'tids' not in cache_dict or expired(cache_dict, cache_for):
+        return False
+    last_transaction = lastTransaction(storage)
+    # storages that cannot tell us their last transaction are refreshed
+    # only when the cache expires
+    return (last_transaction is None or
+            last_transaction == cache_dict['last_transaction'])
+
+
+def isPacked(storage, tids):
+    """Check whether the oldest transaction we know about is gone."""
+    iterator = storage.iterator()
+    try:
+        try:
+            first_record = iter(iterator).next()
+        except StopIteration:
+            return True
+        return first_record.tid != tids[0]
+    finally:
+        # FileStorage iterators keep the file open until closed
+        if hasattr(iterator, 'close'):
+            iterator.close()
+
+
+def refreshStorageTids(storage, cache_dict):
+    # remember this before scanning, so that a transaction committed during
+    # the scan cannot be missed
+    last_transaction = lastTransaction(storage)
+    index = getTransactionIndex(storage)
+    tids = cache_dict.get('tids')
+    first_tid = tids[0] if tids else None
+    if index is not None:
+        index.update()
+        tids = index.tids
+    elif not tids or isPacked(storage, tids):
+        tids = TidArray(t.tid for t in storage.iterator())
+    elif (last_transaction is None or
+          last_transaction != cache_dict['last_transaction']):
+        # okay, look for new transactions appended at the end
+        last = tids[-1]
+        new = [t.tid for t in storage.iterator(start=last)]
+        if new and new[0] == last:
+            del new[0]
+        tids.extend(new)
+    if first_tid is not None and (not tids or tids[0] != first_tid):
+        # the storage was packed, old revisions may be gone
+        HISTORY_RECORDS.pop(storage, None)
+    cache_dict['tids'] = tids
+    cache_dict['last_transaction'] = last_transaction
+    cache_dict['last_update'] = time.time()
+
+
 def getStorageTids(storage, cache_for=5 * MINUTES):
-    cache_dict = STORAGE_TIDS.setdefault(storage, {})
-    if expired(cache_dict, cache_for):
-        if cache_dict.get('tids'):
-            first = cache_dict['tids'][-1]
-            last = cache_dict['tids'][-1]
-            try:
-                first_record = storage.iterator().next()
-            except StopIteration:
-                first_record = None
-            if first_record and first_record.tid == first:
-                # okay, look for new transactions appended at the end
-                new = [t.tid for t in storage.iterator(start=last)]
-                if new and new[0] == last:
-                    del new[0]
-                cache_dict['tids'].extend(new)
-            else:
-                # first record changed, we must've packed the DB
-                cache_dict['tids'] = [t.tid for t in storage.iterator()]
-        else:
-            cache_dict['tids'] = [t.tid for t in storage.iterator()]
-        cache_dict['last_update'] = time.time()
-    return cache_dict['tids']
+    """Return the ids of all transactions in a storage, oldest first.
 
+    The cached list is refreshed only when storage.lastTransaction() changes,
+    and then only new transactions at the end are read.  Every cache_for
+    seconds we also check whether the storage was packed; this check looks
+    only at the first transaction record.
+
+    One thread at a time refreshes the list, while the others keep using the
+    previous one instead of waiting.
+    """
+    with _lock:
+        cache_dict = STORAGE_TIDS.get(storage)
+        if cache_dict is None:
+            cache_dict = STORAGE_TIDS[storage] = {'lock': threading.Lock()}
+    if upToDate(storage, cache_dict, cache_for):
+        return cache_dict['tids']
+    lock = cache_dict['lock']
+    if not lock.acquire(False):
+        if 'tids' in cache_dict:
+            # somebody else is refreshing it, use the old list meanwhile
+            return cache_dict['tids']
+        lock.acquire()
+    try:
+        if not upToDate(storage, cache_dict, cache_for):
+            refreshStorageTids(storage, cache_dict)
+    finally:
+        lock.release()
+    return cache_dict['tids']
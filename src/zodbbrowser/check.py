@@ -4,18 +4,43 @@ import optparse
 import os
 import sys
 import tempfile
+import time
 
-from zodbbrowser.standalone import open_database
+from ZODB.utils import p64, u64
+
+from zodbbrowser.standalone import open_database, add_zeo_options
 from zodbbrowser.references import ReferencesDatabase
 
 
-def iter_database(db):
-    """Iter over records located inside the database."""
-    for transaction in db.storage.iterator():
+def iter_database(db, start=None):
+    """Iter over records located inside the database.
+
+    If start is given, only look at transactions from that tid on.
+    """
+    for transaction in db.storage.iterator(start=start):
         for record in transaction:
             yield record
 
 
+class ProgressReport(object):
+    """Print the number of saved references every interval seconds."""
+
+    def __init__(self, interval=10, stream=None):
+        self.interval = interval
+        self.stream = stream if stream is not None else sys.stderr
+        self.last_report = time.time()
+
+    def __call__(self, rows, seconds):
+        now = time.time()
+        if now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report(rows, seconds)
+
+    def report(self, rows, seconds):
+        print >> self.stream, '{0} references saved ({1:.0f} rows/s).'.format(
+            rows, rows / seconds if seconds else 0)
+
+
 def main(args=None):
     logging.basicConfig(format="%(message)s")
 
@@ -34,6 +59,7 @@ def main(args=None):
                       ' (host:port or socket name)')
     parser.add_option('--storage', metavar='NAME',
                       help='connect to given ZEO storage')
+    add_zeo_options(parser)
     parser.add_option('--db', metavar='DATA.FS',
                       help='use given Data.fs file')
     parser.add_option('--save-references', metavar='FILE.DB', dest='save',
@@ -41,10 +67,37 @@ def main(args=None):
     parser.add_option('--override-references', action="store_true",
                       dest="override", default=False,
                       help='override a reference database')
+    parser.add_option('--update', action="store_true", default=False,
+                      help='update a reference database with the transactions'
+                      ' committed since it was saved')
+    parser.add_option('--migrate', action="store_true", default=False,
+                      help='convert a reference database saved by an older'
+                      ' version to the current format, and exit')
+    parser.add_option('--jobs', metavar='N', type='int', default=1,
+                      help='extract references in N processes'
+                      ' (default: %default)')
     parser.add_option('--rw', action='store_false', dest='readonly',
                       default=True,
                       help='open the database read-write (default: read-only)')
     opts, args = parser.parse_args(args)
+    if opts.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if opts.update and not opts.save:
+        parser.error('--update needs --save-references')
+    if opts.update and opts.override:
+        parser.error('you specified both --update and --override-references;'
+                     ' pick one')
+    if opts.migrate:
+        if not opts.save or not os.path.isfile(opts.save):
+            parser.error('--migrate needs an existing --save-references'
+                         ' database')
+        references = ReferencesDatabase(opts.save)
+        if not references.needsMigration():
+            parser.error('Database does not need migrating.')
+        references.migrateDatabase()
+        references.close()
+        print 'Database migrated.'
+        sys.exit(0)
     try:
         db = open_database(opts)
     except ValueError as error:
@@ -62,15 +115,35 @@ def main(args=None):
         # If we don't save, create a temporary file for the database.
         database_descriptor, database_file = tempfile.mkstemp('zodbchecker')
     references = ReferencesDatabase(database_file)
-    if opts.save:
+    if opts.update:
+        last_tid = None
+        if references.checkDatabase():
+            last_tid = references.getLastTransaction()
+        if last_tid is None:
+            parser.error('Database does not know its last transaction;'
+                         ' rebuild it with --override-references.')
+    elif opts.save:
         if opts.override and os.path.isfile(opts.save):
             os.unlink(opts.save)
-        elif references.checkDatabase():
+        elif references.checkDatabase() or references.needsMigration():
             parser.error('Database already initialized.')
-    references.createDatabase()
-    references.analyzeRecords(iter_database(db))
+    # Remember this before scanning: transactions committed during the scan
+    # will be looked at again by the next update, which is harmless.
+    last_transaction = db.storage.lastTransaction()
+    progress = ProgressReport()
+    started = time.time()
+    if opts.update:
+        records = iter_database(db, start=p64(u64(last_tid) + 1))
+        rows = references.updateRecords(records, progress=progress)
+    else:
+        references.createDatabase()
+        rows = references.analyzeRecords(iter_database(db), progress=progress,
+                                         jobs=opts.jobs)
+    progress.report(rows, time.time() - started)
+    references.setLastTransaction(last_transaction)
 
     missing_oids = references.getMissingOIDs()
+    references.close()
     if not opts.save:
         # Cleanup temporary file
         os.unlink(database_file)
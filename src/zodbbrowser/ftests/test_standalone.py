@@ -18,6 +18,7 @@ from persistent import Persistent
 from ZODB.POSException import ReadOnlyError
 from ZODB.FileStorage.FileStorage import FileStorage
 from ZODB.DB import DB
+from ZODB.interfaces import IDatabase
 from zope.testing.renormalizing import RENormalizing
 from zope.testbrowser.browser import Browser as _Browser
 from zope.testbrowser.interfaces import IBrowser
@@ -26,6 +27,7 @@ from zope.app.publication.zopepublication import ZopePublication
 from zope.app.folder.folder import Folder
 from zope.app.appsetup.interfaces import DatabaseOpened
 from zope.app.appsetup.bootstrap import bootStrapSubscriber
+from zope.component import getUtility
 from zope.interface import Interface, implementsOnly
 
 from zodbbrowser.standalone import main, serve_forever, stop_serving
@@ -216,6 +218,29 @@ class TestCanCreateEmptyDataFs(unittest.TestCase):
         self.assertTrue('zodbbrowser' in browser.contents)
         self.assertTrue('persistent.mapping.PersistentMapping' in browser.contents)
 
+    def test_connection_options(self):
+        self.server.run(self.empty_fs, '--rw', '--pool-size', '3',
+                        '--cache-size', '100', '--cache-size-mb', '2')
+        db = getUtility(IDatabase, '<target>')
+        self.assertEqual(db.getPoolSize(), 3)
+        self.assertEqual(db.getCacheSize(), 100)
+        self.assertEqual(db.getCacheSizeBytes(), 2 * 1024 * 1024)
+
+    def test_connection_options_from_config(self):
+        config = os.path.join(self.tempdir, 'zodb.conf')
+        with open(config, 'w') as f:
+            f.write('<zodb>\n'
+                    '  pool-size 4\n'
+                    '  cache-size 123\n'
+                    '  <filestorage>\n'
+                    '    path %s\n'
+                    '  </filestorage>\n'
+                    '</zodb>\n' % self.empty_fs)
+        self.server.run('--config', config, '--rw')
+        db = getUtility(IDatabase, '<target>')
+        self.assertEqual(db.getPoolSize(), 4)
+        self.assertEqual(db.getCacheSize(), 123)
+
     def test_cannot_start_in_read_only_mode(self):
         self.assertRaises(ReadOnlyError, self.server.run, self.empty_fs)
         # Due to a bug in ZODB, the new database *is* created, it just
@@ -1,6 +1,9 @@
+import bisect
 import inspect
+import threading
+from contextlib import contextmanager
 
-from ZODB.utils import tid_repr
+from ZODB.utils import p64, u64, z64, tid_repr
 from ZODB.interfaces import IConnection
 from ZODB.POSException import POSKeyError
 from persistent import Persistent
@@ -21,16 +24,39 @@ class ZodbObjectHistory(object):
     def __init__(self, obj):
         self._obj = removeAllProxies(obj)
         self._connection = self._obj._p_jar
-        self._storage = self._connection._storage
+        # not self._connection._storage, which may be a per-connection MVCC
+        # adapter: the caches are shared by all connections to a storage
+        self._storage = self._connection.db().storage
         self._oid = self._obj._p_oid
         self._history = None
+        self._recent = []
         self._by_tid = {}
+        self._tids = []
+        self._revisions = {}
 
     def __len__(self):
         if self._history is None:
             self._load()
         return len(self._history)
 
+    def knownLength(self):
+        """Return len(self) if we know it without loading the whole history.
+
+        Returns None otherwise.
+        """
+        if self._history is None:
+            self._loadCached()
+        if self._history is None:
+            return None
+        return len(self._history)
+
+    def _loadCached(self):
+        """Take the whole history from the cache if it is there."""
+        history = cache.getCachedHistoryRecords(self._storage, self._oid)
+        if history is not None:
+            self._history = history
+            self._index_by_tid()
+
     def _load(self):
         """Load history of changes made to a Persistent object.
 
@@ -43,8 +69,16 @@ class ZodbObjectHistory(object):
             description -- short description (often a URL)
 
         See the 'history' method of ZODB.interfaces.IStorage.
+
+        The records are shared with other adapters through a process-wide
+        cache, so they must not be modified.
         """
-        size = 999999999999 # "all of it"; ought to be sufficient
+        self._history = cache.getHistoryRecords(self._storage, self._oid,
+                                                self._loadHistory)
+        self._index_by_tid()
+
+    def _loadHistory(self, size=999999999999):
+        # the default size means "all of it"; ought to be sufficient
         # NB: ClientStorage violates the interface by calling the last
         # argument 'length' instead of 'size'.  To avoid problems we must
         # use positional argument syntax here.
@@ -54,32 +88,89 @@ class ZodbObjectHistory(object):
         # both ZODB versions :(
         if 'version' in inspect.getargspec(self._storage.history)[0]:
             version = None
-            self._history = self._storage.history(self._oid, version, size)
+            return self._storage.history(self._oid, version, size)
         else:
-            self._history = self._storage.history(self._oid, size=size)
-        self._index_by_tid()
+            return self._storage.history(self._oid, size=size)
 
     def _index_by_tid(self):
         for record in self._history:
             self._by_tid[record['tid']] = record
+        # oldest to newest, for bisecting
+        self._tids = [record['tid'] for record in reversed(self._history)]
 
     def __getitem__(self, item):
         if self._history is None:
             self._load()
         return self._history[item]
 
+    def slice(self, start, stop=None):
+        if self._history is None and stop is not None:
+            if len(self._recent) < stop:
+                # storages can look up just the latest revisions, which is
+                # a lot faster than the whole history for busy objects
+                self._recent = self._loadHistory(stop)
+                if len(self._recent) < stop:
+                    # got all of it
+                    self._history = self._recent
+                    self._index_by_tid()
+            return self._recent[start:stop]
+        if self._history is None:
+            self._load()
+        return self._history[start:stop]
+
+    def _rememberRevision(self, tid, serial):
+        """Note that serial is the last change at or before tid."""
+        self._revisions[tid] = serial
+
+    def _quickLastChange(self, tid):
+        """Find the last change at or before tid without loading the history.
+
+        Returns None if that's not possible.
+        """
+        # historical connections show an old state, not the latest one
+        historical = getattr(self._connection, 'before', None) is not None
+        if (tid is None and not historical or
+                isPinnedAt(self._connection, tid)):
+            # our connection has loaded (or can load with a single call)
+            # the revision we're looking for
+            try:
+                self._obj._p_activate()
+            except Exception:
+                # e.g. it did not exist yet; the history will tell
+                return None
+            if self._obj._p_changed or self._obj._p_serial == z64:
+                # modified in this transaction
+                return None
+            return self._obj._p_serial
+        if tid is not None:
+            revisions = cache.loadBefore(self._storage, [self._oid], tid)
+            if self._oid in revisions:
+                data, serial = revisions[self._oid]
+                cache.rememberSerial(self._storage, self._oid, serial, data)
+                return serial
+        return None
+
     def lastChange(self, tid=None):
+        if tid in self._revisions:
+            # we got it from prefetchStates() or _quickLastChange()
+            return self._revisions[tid]
         if self._history is None:
+            serial = self._quickLastChange(tid)
+            if serial is not None:
+                self._rememberRevision(tid, serial)
+                return serial
             self._load()
         if tid in self._by_tid:
             # optimization
             return tid
         # sadly ZODB has no API for get revision at or before tid, so
         # we have to find the exact tid
-        for record in self._history:
-            # we assume records are ordered by tid, newest to oldest
-            if tid is None or record['tid'] <= tid:
-                return record['tid']
+        if tid is None:
+            pos = len(self._tids)
+        else:
+            pos = bisect.bisect_right(self._tids, tid)
+        if pos:
+            return self._tids[pos - 1]
         if tid is None:
             # It means there is just no history, so the object is broken.
             raise POSKeyError(self._obj._p_oid)
@@ -87,12 +178,19 @@ class ZodbObjectHistory(object):
             '%r did not exist in or before transaction %r' %
             (self._obj, tid_repr(tid)))
 
+    def _loadSerial(self, tid):
+        return cache.loadSerial(self._storage, self._oid, tid)
+
+    def _unpickleState(self, data):
+        # this is what Connection.oldstate() does, except that we want
+        # loadSerial() to go through our cache
+        return self._connection._reader.getState(data)
+
     def loadStatePickle(self, tid=None):
-        return self._connection._storage.loadSerial(self._obj._p_oid,
-                                                    self.lastChange(tid))
+        return self._loadSerial(self.lastChange(tid))
 
     def loadState(self, tid=None):
-        return self._connection.oldstate(self._obj, self.lastChange(tid))
+        return self._unpickleState(self.loadStatePickle(tid))
 
     def rollback(self, tid):
         state = self.loadState(tid)
@@ -101,6 +199,85 @@ class ZodbObjectHistory(object):
             self._obj._p_changed = True
 
 
+class ObjectHistoryCache(object):
+    """Cache of IObjectHistory adapters, keyed by oid.
+
+    Every new ZodbObjectHistory fetches the complete history of the object
+    from the storage, and rendering a single page looks at the same objects
+    many times over.  Views keep one of these for the duration of a request.
+    """
+
+    def __init__(self):
+        self._histories = {}
+
+    def __len__(self):
+        return len(self._histories)
+
+    def get(self, obj):
+        obj = removeAllProxies(obj)
+        key = (obj._p_jar, obj._p_oid)
+        history = self._histories.get(key)
+        if history is None or getattr(history, '_obj', None) is not obj:
+            history = self._histories[key] = IObjectHistory(obj)
+        return history
+
+
+_current = threading.local()
+
+
+@contextmanager
+def historyCache(cache):
+    """Make getObjectHistory() use cache in this thread."""
+    previous = getattr(_current, 'cache', None)
+    _current.cache = cache
+    try:
+        yield cache
+    finally:
+        _current.cache = previous
+
+
+def getObjectHistory(obj):
+    """Adapt obj to IObjectHistory, reusing adapters within a request."""
+    cache = getattr(_current, 'cache', None)
+    if cache is None:
+        return IObjectHistory(obj)
+    return cache.get(obj)
+
+
+def isPinnedAt(connection, tid):
+    """Check whether connection is a historical connection opened at tid.
+
+    Such connections (see DB.open(at=tid)) show the database exactly as it
+    was after transaction tid.
+    """
+    if tid is None:
+        return False
+    return getattr(connection, 'before', None) == p64(u64(tid) + 1)
+
+
+def prefetchStates(objects, tid):
+    """Load the states of many objects as of transaction tid in one go.
+
+    Afterwards getObjectHistory(obj).loadState(tid) needs neither the
+    object's history nor another trip to the storage, as long as the
+    same IObjectHistory adapter is reused (see historyCache).
+    """
+    by_jar = {}
+    for obj in objects:
+        obj = removeAllProxies(obj)
+        if isPinnedAt(obj._p_jar, tid):
+            # its connection already loads it as of tid
+            continue
+        if obj._p_jar is not None and obj._p_oid is not None:
+            by_jar.setdefault(obj._p_jar, {})[obj._p_oid] = obj
+    for jar, objs in by_jar.items():
+        revisions = cache.loadBefore(jar.db().storage, list(objs), tid)
+        for oid, (data, serial) in revisions.items():
+            history = getObjectHistory(objs[oid])
+            cache.rememberSerial(history._storage, oid, serial, data)
+            history._rememberRevision(tid, serial)
+
+
 class ZodbHistory(object):
 
     adapts(IConnection)
@@ -108,12 +285,12 @@ class ZodbHistory(object):
 
     def __init__(self, connection):
         self._connection = connection
-        self._storage = connection._storage
-        self._tids = cache.getStorageTids(self._storage)
+        self._storage = connection.db().storage
+        self._tids = cache.getStorageTids(self._storage).view()
 
     @property
     def tids(self):
-        return tuple(self._tids) # readonlify
+        return self._tids
 
     def __len__(self):
         return len(self._tids)
@@ -121,9 +298,22 @@ class ZodbHistory(object):
     def __iter__(self):
         return self._storage.iterator()
 
+    def positionOf(self, tid):
+        return self._tids.index(tid)
+
+    def tidAtOrBefore(self, tid):
+        pos = bisect.bisect_right(self._tids, tid)
+        if not pos:
+            return None
+        return self._tids[pos - 1]
+
     def __getslice__(self, start, stop):
         tids = self._tids[start:stop]
         if not tids:
             return []
+        index = cache.getTransactionIndex(self._storage)
+        if index is not None:
+            # seek straight to the first transaction instead of scanning
+            return index.iterator(tids[0], tids[-1])
         return self._storage.iterator(tids[0], tids[-1])
 
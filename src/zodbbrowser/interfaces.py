@@ -1,4 +1,4 @@
-from zope.interface import Interface
+from zope.interface import Interface, Attribute
 
 
 class HistoryMissingError(ValueError):
@@ -14,7 +14,7 @@ class IReferencesDatabase(Interface):
         """Return true if the database is usable and ready."""
 
     def getUnUsedOIDs():
-        """Return a set of unused OIDs present in the database that are no
+        """Iterate over unused OIDs present in the database that are no
         longer referenced from the root object
         """
 
@@ -53,6 +53,20 @@ class IObjectHistory(Interface):
 
         """
 
+    def slice(start, stop=None):
+        """Return a list of history records from start to stop.
+
+        Like self[start:stop], but storages can avoid loading the entire
+        history when only the latest few records are needed.
+        """
+
+    def knownLength():
+        """Return the number of history records, if known.
+
+        Returns None unless the entire history has been loaded already
+        (possibly by another view, and kept in the history cache).
+        """
+
     def lastChange(tid=None):
         """Return the last transaction at or before tid.
 
@@ -85,6 +99,11 @@ class IDatabaseHistory(Interface):
     Adapt a connection object to IObjectHistory.
     """
 
+    tids = Attribute("Sequence of all transaction IDs, from oldest to newest.")
+
+    def __len__():
+        """Return the number of transactions."""
+
     def __iter__(n):
         """Return an iterator over the history record.
 
@@ -93,6 +112,20 @@ class IDatabaseHistory(Interface):
         Each record provides ZODB.interfaces.an IStorageTransactionInformation.
         """
 
+    def positionOf(tid):
+        """Return the index of a transaction in the tids sequence.
+
+        Raises ValueError if there is no transaction with this exact tid.
+        Takes logarithmic time.
+        """
+
+    def tidAtOrBefore(tid):
+        """Return the last transaction ID at or before tid.
+
+        Returns None if tid predates all the transactions.  Takes
+        logarithmic time.
+        """
+
 
 class IValueRenderer(Interface):
     """Renderer of attribute values."""
@@ -0,0 +1,71 @@
+"""
+Compact in-memory graph of the references between objects.
+"""
+
+import bisect
+from array import array
+
+
+class LinkGraph(object):
+    """Graph of references between objects, in compressed sparse row form.
+
+    Three flat integer arrays instead of dicts and sets of Python ints:
+    nodes holds the sorted oids of all objects, the targets of the i-th
+    object are targets[offsets[i]:offsets[i + 1]].  That is 8 bytes per
+    object and per reference, however big the database is.
+    """
+
+    def __init__(self, links):
+        """Build the graph from (source_oid, target_oid) pairs.
+
+        The pairs must be sorted by source oid.  Objects without references
+        come with a None (or negative) target, which is skipped.
+        """
+        self.nodes = array('l')
+        self.offsets = array('l')
+        self.targets = array('l')
+        for source_oid, target_oid in links:
+            if not self.nodes or self.nodes[-1] != source_oid:
+                self.nodes.append(source_oid)
+                self.offsets.append(len(self.targets))
+            if target_oid is not None and target_oid >= 0:
+                self.targets.append(target_oid)
+        self.offsets.append(len(self.targets))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def _index(self, oid):
+        index = bisect.bisect_left(self.nodes, oid)
+        if index < len(self.nodes) and self.nodes[index] == oid:
+            return index
+        return None
+
+    def reachable(self, root_oid=0):
+        """Return a bytearray flagging the objects reachable from root_oid.
+
+        Indexes are the same as in self.nodes.  References to objects that
+        are not in the graph are ignored.
+        """
+        seen = bytearray(len(self.nodes))
+        start = self._index(root_oid)
+        if start is None:
+            return seen
+        seen[start] = 1
+        stack = array('l', [start])
+        offsets, targets = self.offsets, self.targets
+        while stack:
+            index = stack.pop()
+            for target_oid in targets[offsets[index]:offsets[index + 1]]:
+                target = self._index(target_oid)
+                if target is not None and not seen[target]:
+                    seen[target] = 1
+                    stack.append(target)
+        return seen
+
+    def unreachable(self, root_oid=0):
+        """Iterate over the oids not reachable from root_oid, in order."""
+        seen = self.reachable(root_oid)
+        for index, oid in enumerate(self.nodes):
+            if not seen[index]:
+                yield oid
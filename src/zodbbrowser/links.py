@@ -3,7 +3,7 @@ import optparse
 import sys
 
 from ZODB.utils import p64
-from zodbbrowser.standalone import open_database
+from zodbbrowser.standalone import open_database, add_zeo_options
 from zodbbrowser.references import ReferencesDatabase
 
 
@@ -26,6 +26,7 @@ def main(args=None):
                       ' (host:port or socket name)')
     parser.add_option('--storage', metavar='NAME',
                       help='connect to given ZEO storage')
+    add_zeo_options(parser)
     parser.add_option('--db', metavar='DATA.FS',
                       help='use given Data.fs file')
     parser.add_option('--depth', metavar='DEPTH', dest='depth', type='int',
@@ -37,7 +38,11 @@ def main(args=None):
                       help='oid')
     opts, args = parser.parse_args(args)
     try:
-        refs = ReferencesDatabase(opts.refsdb)
+        refs = ReferencesDatabase(opts.refsdb, readonly=True)
+        if refs.needsMigration():
+            parser.error('reference database is in an old format; convert'
+                         ' it with zodbcheck --save-references FILE.DB'
+                         ' --migrate')
     except ValueError as error:
         parser.error(error.args[0])
     try:
@@ -0,0 +1,125 @@
+"""
+Delete unused objects straight from a relational database.
+"""
+
+import itertools
+import os
+import time
+
+
+PLACEHOLDERS = {
+    'qmark': '?',
+    'format': '%s',
+    'pyformat': '%s',
+}
+
+
+class PackExecutor(object):
+    """Delete objects from the object_state table in batches.
+
+    Works with any DB-API connection; paramstyle is the paramstyle of its
+    module (e.g. 'qmark' for sqlite3, 'pyformat' for psycopg2).
+
+    Every batch is deleted and committed separately.  The batch size adapts
+    so that a batch takes about target_latency seconds, which keeps the
+    locks and the write-ahead log of every transaction small.
+
+    If checkpoint names a file, the last deleted oid is saved there after
+    every batch, and an interrupted run started again with the same oids
+    skips the ones it already deleted.  For that the oids must come in
+    ascending order, which is how ReferencesDatabase.getUnUsedOIDs()
+    returns them.  The checkpoint is removed once a run completes.
+
+    source identifies where the oids come from (sqlpack uses the last
+    transaction of the reference database).  It is saved with the
+    checkpoint, and a checkpoint saved for another source is refused,
+    since skipping oids by it could leave unused objects behind.
+    """
+
+    def __init__(self, connection, paramstyle='qmark', target_latency=1.0,
+                 batch_size=1000, min_batch_size=10, max_batch_size=10000,
+                 pause=0, checkpoint=None, source='', progress=None,
+                 clock=time.time):
+        self.connection = connection
+        self.placeholder = PLACEHOLDERS[paramstyle]
+        self.target_latency = target_latency
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.pause = pause
+        self.checkpoint = checkpoint
+        self.source = source
+        self.progress = progress
+        self.clock = clock
+        self.deleted = 0
+
+    def readCheckpoint(self):
+        """Return the last oid deleted by a previous run, or None.
+
+        Raises ValueError if the checkpoint was saved for another source.
+        """
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return None
+        with open(self.checkpoint) as f:
+            oid, source = f.read().split('\n')[:2]
+        if source != self.source:
+            raise ValueError(
+                '{} was saved for different oids ({!r} instead of {!r});'
+                ' remove it to start over'.format(self.checkpoint, source,
+                                                  self.source))
+        return int(oid)
+
+    def writeCheckpoint(self, oid):
+        # write and rename, so an interruption cannot leave half a number
+        tmp = self.checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('{}\n{}\n'.format(oid, self.source))
+        os.rename(tmp, self.checkpoint)
+
+    def deleteBatch(self, oids):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'DELETE FROM object_state WHERE zoid IN ({})'.format(
+                ','.join([self.placeholder] * len(oids))),
+            oids)
+        self.connection.commit()
+
+    def adjustBatchSize(self, seconds):
+        """Scale the batch size towards the target latency.
+
+        It changes by at most a factor of 2 per batch, so that one slow
+        or fast batch does not throw it off.
+        """
+        if seconds > 0:
+            factor = self.target_latency / seconds
+        else:
+            factor = 2
+        factor = min(max(factor, 0.5), 2)
+        self.batch_size = int(min(max(self.batch_size * factor,
+                                      self.min_batch_size),
+                                  self.max_batch_size))
+
+    def run(self, oids):
+        """Delete the given objects; return how many were deleted."""
+        last_oid = self.readCheckpoint()
+        oids = iter(oids)
+        if last_oid is not None:
+            oids = itertools.dropwhile(lambda oid: oid <= last_oid, oids)
+        started = self.clock()
+        while True:
+            batch = list(itertools.islice(oids, self.batch_size))
+            if not batch:
+                break
+            batch_started = self.clock()
+            self.deleteBatch(batch)
+            self.adjustBatchSize(self.clock() - batch_started)
+            self.deleted += len(batch)
+            if self.checkpoint is not None:
+                self.writeCheckpoint(batch[-1])
+            if self.progress is not None:
+                self.progress(self.deleted, self.clock() - started)
+            if self.pause:
+                time.sleep(self.pause)
+        if self.checkpoint is not None and os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        return self.deleted
@@ -1,28 +1,122 @@
 
+import collections
+import itertools
+import multiprocessing
+import os
 import sqlite3
+import threading
+import time
+import urllib
 
-from ZODB.utils import u64
+from ZODB.utils import p64, u64, get_pickle_metadata
 from ZODB.serialize import referencesf
 from zope.interface import implements
 
 from zodbbrowser.interfaces import IReferencesDatabase
+from zodbbrowser.linkgraph import LinkGraph
+
+
+# records saved per executemany() call while loading references
+BATCH_SIZE = 10000
+
+# settings for loading a fresh database: a crash halfway through leaves a
+# useless database anyway, so there's no point in journaling or syncing it
+INGEST_PRAGMAS = [
+    ('journal_mode', 'MEMORY'),
+    ('synchronous', 'OFF'),
+    ('cache_size', '-262144'),  # KiB, i.e. 256 MB
+]
+
+# rows fetched at a time by the queries that stream their results
+FETCH_SIZE = 10000
+
+# records sent to a worker process at a time by iter_analyzed_parallel,
+# and replaced at a time by ReferencesDatabase.updateRecords
+CHUNK_SIZE = 1000
+
+
+def analyze_record(oid, tid, data):
+    """Return what the references database keeps about one record.
+
+    That is a (source_oid, info, links) tuple, where info is a (tid,
+    class name, size) tuple, or None for a deleted object, and links is a
+    list of (source_oid, target_oid) pairs.
+    """
+    source_oid = u64(oid)
+    if data is None:
+        return source_oid, None, []
+    module, name = get_pickle_metadata(data)
+    class_name = '{}.{}'.format(module, name) if module else name
+    target_oids = sorted(set(map(u64, referencesf(data))))
+    return (source_oid, (u64(tid), class_name, len(data)),
+            [(source_oid, target_oid) for target_oid in target_oids])
+
+
+def iter_analyzed(records):
+    """Iterate over analyze_record() results of database records."""
+    for record in records:
+        yield analyze_record(record.oid, record.tid, record.data)
+
+
+def analyze_chunk(chunk):
+    """Return the analyze_record() results of (oid, tid, data) tuples.
+
+    Runs in the worker processes of iter_analyzed_parallel.
+    """
+    return [analyze_record(oid, tid, data) for oid, tid, data in chunk]
+
+
+def iter_analyzed_parallel(records, jobs, chunk_size=CHUNK_SIZE):
+    """Like iter_analyzed, but unpickle the records in jobs processes.
+
+    Records are sent to the workers in chunks of chunk_size, and at most
+    two chunks per worker are in flight, so a big database is not read
+    into memory faster than it can be analyzed.  Results come out in the
+    same order as from iter_analyzed.
+    """
+    pool = multiprocessing.Pool(jobs)
+    try:
+        pending = collections.deque()
+        records = ((record.oid, record.tid, record.data)
+                   for record in records)
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if chunk:
+                pending.append(pool.apply_async(analyze_chunk, (chunk, )))
+            if pending and (not chunk or len(pending) >= 2 * jobs):
+                for result in pending.popleft().get():
+                    yield result
+            elif not chunk:
+                break
+    finally:
+        pool.terminate()
+        pool.join()
 
 
 def connect(callback):
-    """Decorator for the reference database to access the sqlite DB."""
+    """Decorator for the reference database to access the sqlite DB.
+
+    Every thread keeps its connection open between calls, so that sqlite's
+    page cache and compiled statements are reused.
+    """
 
     def wrapper(self, *args, **kwargs):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            try:
+                connection = self._connect()
+            except:
+                raise ValueError(
+                    'impossible to open references database {}.'.format(
+                        self.db_name))
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
         try:
-            connection = sqlite3.connect(self.db_name)
-        except:
-            raise ValueError(
-                'impossible to open references database {}.'.format(
-                    self.db_name))
-        try:
-            result = callback(self, connection, *args, **kwargs)
-        finally:
-            connection.close()
-        return result
+            return callback(self, connection, *args, **kwargs)
+        except Exception:
+            connection.rollback()
+            raise
 
     return wrapper
 
@@ -30,69 +124,278 @@ def connect(callback):
 class ReferencesDatabase(object):
     implements(IReferencesDatabase)
 
-    def __init__(self, db_name):
+    def __init__(self, db_name, readonly=False):
         self.db_name = db_name
+        self.readonly = readonly
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # close() may be called from another thread
+        if not self.readonly:
+            return sqlite3.connect(self.db_name, check_same_thread=False)
+        uri = 'file:{}?mode=ro'.format(
+            urllib.pathname2url(os.path.abspath(self.db_name)))
+        try:
+            connection = sqlite3.connect(uri, check_same_thread=False)
+        except sqlite3.OperationalError:
+            # this sqlite does not understand URIs
+            connection = sqlite3.connect(self.db_name,
+                                         check_same_thread=False)
+        connection.execute('PRAGMA query_only = ON')
+        return connection
+
+    def close(self):
+        """Close the connections of all threads."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        for connection in connections:
+            connection.close()
+
+    @connect
+    def analyzeRecords(self, connection, records, batch_size=BATCH_SIZE,
+                       progress=None, jobs=1):
+        """Save the references of the given database records.
+
+        Records are saved batch_size at a time, and the indexes are built
+        once all of them are in.  If given, progress(rows, seconds) is
+        called after every batch.  With jobs > 1 the records are
+        unpickled in that many worker processes.  Returns the number of
+        rows inserted.
+        """
+        cursor = connection.cursor()
+        saved_pragmas = []
+        for name, value in INGEST_PRAGMAS:
+            saved_pragmas.append(
+                (name, cursor.execute('PRAGMA ' + name).fetchone()[0]))
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        started = time.time()
+        rows = 0
+        class_ids = self._getClassIds(cursor)
+        if jobs > 1:
+            analyzed = iter_analyzed_parallel(records, jobs)
+        else:
+            analyzed = iter_analyzed(records)
+        while True:
+            batch = list(itertools.islice(analyzed, batch_size))
+            if not batch:
+                break
+            rows += self._saveObjects(cursor, class_ids, batch)
+            if progress is not None:
+                progress(rows, time.time() - started)
+        self._createIndexes(cursor)
+        connection.commit()
+        # the connection stays open for other uses
+        for name, value in saved_pragmas:
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+        return rows
 
     @connect
-    def analyzeRecords(self, connection, records):
+    def updateRecords(self, connection, records, chunk_size=CHUNK_SIZE,
+                      progress=None):
+        """Replace the references of the objects in the given records.
+
+        For updating an existing database with the records of new
+        transactions.  Records with no data (deleted objects) just drop
+        the object.  Returns the number of rows inserted.
+        """
         cursor = connection.cursor()
-        for record in records:
-            current_oid = u64(record.oid)
-            referred_oids = set(map(u64, referencesf(record.data)))
+        started = time.time()
+        rows = 0
+        class_ids = self._getClassIds(cursor)
+        records = iter(records)
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                break
+            # only the newest revision of every object matters
+            latest = collections.OrderedDict()
+            for record in chunk:
+                latest[u64(record.oid)] = record
+            cursor.executemany("""
+DELETE FROM edges WHERE source_oid = ?
+            """, [(oid, ) for oid in latest])
+            cursor.executemany("""
+DELETE FROM objects WHERE oid = ?
+            """, [(oid, ) for oid, record in latest.items()
+                  if record.data is None])
+            rows += self._saveObjects(cursor, class_ids,
+                                      iter_analyzed(latest.values()))
+            if progress is not None:
+                progress(rows, time.time() - started)
+        connection.commit()
+        return rows
 
-            for referred_oid in referred_oids or [-1]:
+    def _getClassIds(self, cursor):
+        return dict(cursor.execute("SELECT name, class_id FROM classes"))
+
+    def _saveObjects(self, cursor, class_ids, analyzed):
+        objects = []
+        edges = []
+        for source_oid, info, links in analyzed:
+            if info is None:
+                continue
+            tid, class_name, size = info
+            class_id = class_ids.get(class_name)
+            if class_id is None:
                 cursor.execute("""
-INSERT INTO links (source_oid, target_oid) VALUES
+INSERT INTO classes (name) VALUES (?)
+                """, (class_name, ))
+                class_id = class_ids[class_name] = cursor.lastrowid
+            objects.append((source_oid, tid, class_id, size))
+            edges.extend(links)
+        # a history-preserving storage has many revisions of an object
+        cursor.executemany("""
+INSERT OR REPLACE INTO objects (oid, tid, class_id, size) VALUES
+(?, ?, ?, ?)
+        """, objects)
+        cursor.executemany("""
+INSERT OR IGNORE INTO edges (source_oid, target_oid) VALUES
 (?, ?)
-            """, (current_oid, referred_oid))
-        connection.commit()
+        """, edges)
+        return len(objects) + len(edges)
 
     @connect
     def createDatabase(self, connection):
-        cursor = connection.cursor()
+        self._createTables(connection.cursor())
+        connection.commit()
+
+    def _createTables(self, cursor):
         cursor.execute("""
-CREATE TABLE IF NOT EXISTS links
-(source_oid BIGINT, target_oid BIGINT)
+CREATE TABLE IF NOT EXISTS objects
+(oid INTEGER PRIMARY KEY, tid INTEGER, class_id INTEGER, size INTEGER)
         """)
         cursor.execute("""
-CREATE INDEX IF NOT EXISTS source_oid_index ON links (source_oid)
+CREATE TABLE IF NOT EXISTS classes
+(class_id INTEGER PRIMARY KEY, name TEXT UNIQUE)
         """)
         cursor.execute("""
-CREATE INDEX IF NOT EXISTS target_oid_index ON links (target_oid)
+CREATE TABLE IF NOT EXISTS edges
+(source_oid INTEGER, target_oid INTEGER,
+ PRIMARY KEY (source_oid, target_oid)) WITHOUT ROWID
         """)
+        cursor.execute("""
+CREATE TABLE IF NOT EXISTS info
+(name TEXT PRIMARY KEY, value)
+        """)
+
+    @connect
+    def needsMigration(self, connection):
+        """Return true if the database has the old links table."""
+        cursor = connection.cursor()
+        result = cursor.execute("""
+SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'links'
+        """)
+        return result.fetchone() is not None
+
+    @connect
+    def migrateDatabase(self, connection):
+        """Convert a database with the old links table to the new tables.
+
+        The old format did not keep the tids, classes and sizes of
+        objects, so they are left empty.
+        """
+        cursor = connection.cursor()
+        self._createTables(cursor)
+        cursor.execute("""
+INSERT OR IGNORE INTO objects (oid)
+SELECT DISTINCT source_oid FROM links
+        """)
+        cursor.execute("""
+INSERT OR IGNORE INTO edges (source_oid, target_oid)
+SELECT source_oid, target_oid FROM links WHERE target_oid > -1
+ORDER BY source_oid, target_oid
+        """)
+        cursor.execute("DROP TABLE links")
+        self._createIndexes(cursor)
+        connection.commit()
+        # give the space of the old table back
+        cursor.execute("VACUUM")
+
+    @connect
+    def getLastTransaction(self, connection):
+        """Return the id of the last transaction analyzed into the database.
+
+        Returns None if it is not known.
+        """
+        cursor = connection.cursor()
+        try:
+            result = cursor.execute("""
+SELECT value FROM info WHERE name = 'last_tid'
+            """).fetchone()
+        except sqlite3.OperationalError:
+            # databases created by older versions have no info table
+            return None
+        if result is None:
+            return None
+        return p64(result[0])
+
+    @connect
+    def setLastTransaction(self, connection, tid):
+        cursor = connection.cursor()
+        cursor.execute("""
+INSERT OR REPLACE INTO info (name, value) VALUES ('last_tid', ?)
+        """, (u64(tid), ))
         connection.commit()
 
+    def _createIndexes(self, cursor):
+        # source_oid is the start of the primary key of edges, so only
+        # target_oid needs an index
+        cursor.execute("""
+CREATE INDEX IF NOT EXISTS edges_target_index ON edges (target_oid)
+        """)
+
     @connect
     def checkDatabase(self, connection):
         cursor = connection.cursor()
         try:
-            result = cursor.execute("SELECT count(*) FROM links")
+            result = cursor.execute("SELECT oid FROM objects LIMIT 1")
+            result.fetchall()
+            result = cursor.execute("SELECT source_oid FROM edges LIMIT 1")
             result.fetchall()
         except sqlite3.OperationalError:
             return False
         return True
 
     @connect
-    def getUnUsedOIDs(self, connection):
-        oids = set([])
+    def getUnUsedOIDs(self, connection, in_memory=False):
+        """Iterate over the oids not reachable from the root object.
+
+        The oids come out in order as the query produces them, so there's
+        no need to hold all of them in memory.  With in_memory, load the
+        whole graph into a LinkGraph and walk it there instead of with a
+        recursive query, which is a lot faster on big databases.
+        """
         cursor = connection.cursor()
+        if in_memory:
+            graph = LinkGraph(cursor.execute("""
+SELECT object.oid, edge.target_oid
+FROM objects AS object LEFT OUTER JOIN edges AS edge
+    ON edge.source_oid = object.oid
+ORDER BY object.oid
+            """))
+            for oid in graph.unreachable():
+                yield oid
+            return
         result = cursor.execute("""
-WITH RECURSIVE links_to_root (source_oid, target_oid) AS (
-    SELECT source_oid, target_oid
-    FROM links
-    WHERE source_oid = 0
+WITH RECURSIVE reachable (oid) AS (
+    SELECT oid FROM objects WHERE oid = 0
     UNION
-    SELECT linked.source_oid, linked.target_oid
-    FROM links AS linked JOIN links_to_root AS origin
-        ON origin.target_oid = linked.source_oid
-    ORDER BY linked.source_oid
+    SELECT edge.target_oid
+    FROM edges AS edge JOIN reachable
+        ON edge.source_oid = reachable.oid
 )
-SELECT DISTINCT source_oid FROM links
-EXCEPT SELECT DISTINCT source_oid FROM links_to_root
+SELECT oid FROM objects WHERE oid NOT IN (SELECT oid FROM reachable)
+ORDER BY oid
         """)
-        for oid in result.fetchall():
-            oids.add(oid[0])
-        return oids
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                yield row[0]
 
     @connect
     def linkedToOID(self, connection, oid, depth):
@@ -100,14 +403,14 @@ EXCEPT SELECT DISTINCT source_oid FROM links_to_root
         result = cursor.execute("""
 WITH RECURSIVE linked_to_oid (source_oid, depth) AS (
     SELECT source_oid, 1
-    FROM links
+    FROM edges
     WHERE target_oid = ?
     UNION
-    SELECT link.source_oid, target.depth + 1
-    FROM links AS link JOIN linked_to_oid AS target
-        ON target.source_oid = link.target_oid
+    SELECT edge.source_oid, target.depth + 1
+    FROM edges AS edge JOIN linked_to_oid AS target
+        ON target.source_oid = edge.target_oid
     WHERE target.depth < ?
-    ORDER BY link.source_oid
+    ORDER BY edge.source_oid
 )
 SELECT DISTINCT source_oid, depth FROM linked_to_oid WHERE depth = ?
         """, (oid, depth, depth))
@@ -121,9 +424,8 @@ SELECT DISTINCT source_oid, depth FROM linked_to_oid WHERE depth = ?
         oids = set([])
         cursor = connection.cursor()
         result = cursor.execute("""
-SELECT a.target_oid FROM links AS a LEFT OUTER JOIN links AS b
-ON a.target_oid = b.source_oid
-WHERE a.target_oid > -1 AND b.source_oid IS NULL
+SELECT DISTINCT target_oid FROM edges
+WHERE NOT EXISTS (SELECT 1 FROM objects WHERE oid = edges.target_oid)
         """)
         for oid in result.fetchall():
             oids.add(oid[0])
@@ -134,8 +436,8 @@ WHERE a.target_oid > -1 AND b.source_oid IS NULL
         oids = set([])
         cursor = connection.cursor()
         result = cursor.execute("""
-SELECT target_oid FROM links
-WHERE source_oid = ? AND target_oid > -1
+SELECT target_oid FROM edges
+WHERE source_oid = ?
         """, (u64(oid), ))
         for oid in result.fetchall():
             oids.add(oid[0])
@@ -146,7 +448,7 @@ WHERE source_oid = ? AND target_oid > -1
         oids = set([])
         cursor = connection.cursor()
         result = cursor.execute("""
-SELECT source_oid FROM links
+SELECT source_oid FROM edges
 WHERE target_oid = ?
         """, (u64(oid), ))
         for oid in result.fetchall():
@@ -55,6 +55,11 @@ function collapseOrExpand() {
     if (content.is(':hidden')) {
         $(icon).attr('src', $('#collapseImg').attr('src'));
         content.slideDown();
+        var lazy = content.children('ol.lazy');
+        if (lazy.length) {
+            lazy.removeClass('lazy');
+            loadObjects(lazy.find('li.more-objects a')[0]);
+        }
     } else {
         $(icon).attr('src', $('#expandImg').attr('src'));
         content.slideUp();
@@ -166,6 +171,52 @@ function doRollback() {
     rollback_form.submit();
 }
 
+function loadDiff(event) {
+    event.preventDefault();
+    var placeholder = $(this).closest('div.diff');
+    placeholder.text("Loading...");
+    $.ajax({url: $(this).attr('href'),
+            success: function(data, status) {
+                placeholder.replaceWith(data);
+                if ($('.filter').length) {
+                    filterHistory();
+                }
+            }});
+}
+
+function loadObjects(link) {
+    var placeholder = $(link).closest('li');
+    var list = placeholder.closest('ol');
+    placeholder.text("Loading...");
+    $.ajax({url: $(link).attr('href'),
+            success: function(data, status) {
+                placeholder.replaceWith(data);
+                list.find('li.more-objects a').click(clickLoadObjects);
+            }});
+}
+
+function clickLoadObjects(event) {
+    event.preventDefault();
+    $(this).closest('ol').removeClass('lazy');
+    loadObjects(this);
+}
+
+function loadMoreHistory(event) {
+    event.preventDefault();
+    var more = $(this).closest('div.more-history');
+    more.text("Loading...");
+    $.ajax({url: $(this).attr('rel'),
+            success: function(data, status) {
+                more.replaceWith(data);
+                $('div.more-history a').click(loadMoreHistory);
+                $('div.collapsed a').unbind('click').click(loadDiff);
+                $('input.rollbackbtn').unbind('click').click(pressRollback);
+                if ($('.filter').length) {
+                    filterHistory();
+                }
+            }});
+}
+
 $(document).ready(function() {
     $('.expander').click(collapseOrExpand);
     hideItemsIfTooMany();
@@ -191,6 +242,9 @@ $(document).ready(function() {
         }
     });
     $('input.rollbackbtn').click(pressRollback);
+    $('div.more-history a').click(loadMoreHistory);
+    $('div.collapsed a').click(loadDiff);
+    $('li.more-objects a').click(clickLoadObjects);
     $('span.truncated').click(function(event){
         event.preventDefault();
         var placeholder = $(this);
@@ -6,7 +6,7 @@ import sys
 import types
 
 import ZODB.broken
-from zodbbrowser.standalone import open_database
+from zodbbrowser.standalone import open_database, add_zeo_options
 
 
 class BrokenRecord(ValueError):
@@ -79,6 +79,7 @@ def main(args=None):
                       ' (host:port or socket name)')
     parser.add_option('--storage', metavar='NAME',
                       help='connect to given ZEO storage')
+    add_zeo_options(parser)
     parser.add_option('--db', metavar='DATA.FS',
                       help='use given Data.fs file')
     parser.add_option('--data', action="store_true",
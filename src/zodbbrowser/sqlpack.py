@@ -4,28 +4,71 @@ import os
 import sys
 import pkg_resources
 import shutil
+from multiprocessing.pool import ThreadPool
 
 import ZODB.blob
 import ZODB.utils
+from BTrees.LLBTree import LLTreeSet
+from zodbbrowser.packer import PackExecutor
 from zodbbrowser.references import ReferencesDatabase
 
 
-def list_all_blobs_in(base_dir):
-    blobs = set()
+# threads listing blob directories at the same time
+SCAN_THREADS = 8
+
+
+def list_directory(path):
+    """Return the subdirectories of path, and whether it contains files.
+
+    Only names that do not end with .blob are checked for being
+    directories, which saves a stat() call for every blob file.
+    """
+    subdirectories = []
+    has_files = False
+    for name in os.listdir(path):
+        if not name.endswith('.blob') and os.path.isdir(
+                os.path.join(path, name)):
+            subdirectories.append(name)
+        elif name != '.layout':
+            has_files = True
+    return subdirectories, has_files
+
+
+def list_all_blobs_in(base_dir, layout=None, threads=SCAN_THREADS):
+    """Return the oids of the blobs stored in base_dir.
+
+    The tree is scanned one level at a time, listing the directories of
+    every level in a pool of threads, since on network storage most of the
+    time goes into waiting for the directory listings.
+    """
+    blobs = LLTreeSet()
     if not base_dir:
         return blobs
-    trim_size = len(base_dir.rstrip(os.path.sep)) + 1
-    for (directory, _, filenames) in os.walk(base_dir):
-        if not filenames or '.layout' in filenames:
-            continue
-        blobs.add(directory[trim_size:])
+    pool = ThreadPool(threads)
+    try:
+        level = ['']
+        while level:
+            listings = pool.map(
+                lambda path: list_directory(os.path.join(base_dir, path)),
+                level, chunksize=64)
+            next_level = []
+            for path, (subdirectories, has_files) in zip(level, listings):
+                if has_files and path:
+                    add_blob(blobs, layout, path)
+                next_level.extend(os.path.join(path, name)
+                                  for name in subdirectories)
+            level = next_level
+    finally:
+        pool.close()
+        pool.join()
     return blobs
 
 
-def read_manifest(manifest):
-    blobs = set()
+def read_manifest(manifest, layout):
+    """Return the oids of the blobs listed in a manifest file."""
+    blobs = LLTreeSet()
     with open(manifest, 'r') as stream:
-        for line in stream.readlines():
+        for line in stream:
             line = line.strip()
             if not len(line):
                 continue
@@ -33,10 +76,63 @@ def read_manifest(manifest):
             if not (len(blob) and blob.startswith('0x00')):
                 print 'This does not look like a blob directory to me.'
                 sys.exit(-1)
-            blobs.add(blob)
+            add_blob(blobs, layout, blob)
     return blobs
 
 
+def add_blob(blobs, layout, path):
+    try:
+        oid = layout.path_to_oid(path)
+    except ValueError:
+        # not a blob directory, e.g. tmp
+        return
+    blobs.add(ZODB.utils.u64(oid))
+
+
+def delete_statement(oids):
+    """Return an SQL statement deleting the given objects."""
+    if len(oids) == 1:
+        return 'DELETE FROM object_state WHERE zoid = {};\n'.format(oids[0])
+    return 'DELETE FROM object_state WHERE zoid = ANY(ARRAY[{}]);\n'.format(
+        ','.join(str(oid) for oid in oids))
+
+
+def write_sql_files(oids, output, lines, statement_size):
+    """Write SQL files deleting the given objects for sql.sh to run."""
+    filename_count = 1
+    sql = None
+    statement = []
+    for count_oid, oid in enumerate(oids, 1):
+        if sql is None:
+            sql = open(os.path.join(
+                output,
+                'todo',
+                'pack-{:06}.sql'.format(filename_count)), 'w')
+            filename_count += 1
+            sql.write('BEGIN;\n')
+        statement.append(oid)
+        if len(statement) == statement_size:
+            sql.write(delete_statement(statement))
+            statement = []
+        if count_oid % lines == 0:
+            if statement:
+                sql.write(delete_statement(statement))
+                statement = []
+            sql.write('COMMIT;\n')
+            sql.close()
+            sql = None
+    if sql is not None:
+        if statement:
+            sql.write(delete_statement(statement))
+        sql.write('COMMIT;\n')
+        sql.close()
+
+
+def report_progress(deleted, seconds):
+    print >> sys.stderr, '{0} objects deleted ({1:.0f} objects/s).'.format(
+        deleted, deleted / seconds if seconds else 0)
+
+
 def main(args=None):
     logging.basicConfig(format="%(message)s")
 
@@ -56,32 +152,72 @@ def main(args=None):
     parser.add_option('--blobs-manifest', metavar='MANIFEST',
                       dest='blobs_manifest',
                       help='result of "find 0x00 -type f" in blobs directory')
+    parser.add_option('--scan-threads', metavar='NUMBER', type=int,
+                      dest='scan_threads', default=SCAN_THREADS,
+                      help='number of threads scanning the blobs directory'
+                      ' (default: %default)')
     parser.add_option('--lines', metavar='NUMBER', dest='lines', type=int,
-                      help='Number of lines per file', default=50000)
+                      help='Number of objects deleted per file', default=50000)
+    parser.add_option('--statement-size', metavar='NUMBER',
+                      dest='statement_size', type=int, default=1,
+                      help='delete that many objects per SQL statement, with'
+                      ' "zoid = ANY(ARRAY[...])" (default: %default)')
     parser.add_option('--output', metavar='OUTPUT', dest='output',
                       help='Output directory', default='pack')
+    parser.add_option('--execute', metavar='DSN',
+                      help='delete the objects from this PostgreSQL database'
+                      ' right away instead of writing SQL files; an'
+                      ' interrupted run continues where it stopped')
+    parser.add_option('--target-latency', metavar='SECONDS', type=float,
+                      dest='target_latency', default=1.0,
+                      help='with --execute, delete as many objects per'
+                      ' transaction as take this long (default: %default)')
+    parser.add_option('--pause', metavar='SECONDS', type=float, default=0,
+                      help='with --execute, wait this long between'
+                      ' transactions (default: %default)')
+    parser.add_option('--in-memory', action='store_true', dest='in_memory',
+                      default=False,
+                      help='find unused objects by loading the references'
+                      ' into memory instead of with a recursive SQL query')
     opts, args = parser.parse_args(args)
+    if opts.statement_size < 1:
+        parser.error('--statement-size must be at least 1')
     try:
-        refs = ReferencesDatabase(opts.refsdb)
+        refs = ReferencesDatabase(opts.refsdb, readonly=True)
+        if refs.needsMigration():
+            parser.error('reference database is in an old format; convert'
+                         ' it with zodbcheck --save-references FILE.DB'
+                         ' --migrate')
     except ValueError as error:
         parser.error(error.args[0])
+    if opts.blobs_manifest and not opts.blobs:
+        parser.error('--blobs-manifest needs --blobs')
+    if opts.scan_threads < 1:
+        parser.error('--scan-threads must be at least 1')
+    layout = None
+    if opts.blobs:
+        layout = ZODB.blob.FilesystemHelper(opts.blobs).layout
     if opts.blobs_manifest:
-        blobs = read_manifest(opts.blobs_manifest)
+        blobs = read_manifest(opts.blobs_manifest, layout)
     else:
-        blobs = list_all_blobs_in(opts.blobs)
+        blobs = list_all_blobs_in(opts.blobs, layout, opts.scan_threads)
+    if opts.execute:
+        try:
+            import psycopg2
+        except ImportError:
+            parser.error('--execute needs psycopg2')
+        if not os.path.isdir(opts.output):
+            os.makedirs(opts.output)
+    else:
+        os.makedirs(opts.output)
+        shutil.copyfile(
+            pkg_resources.resource_filename('zodbbrowser', 'sql.sh'),
+            os.path.join(os.path.join(opts.output, 'sql.sh')))
+        os.makedirs(os.path.join(opts.output, 'todo'))
     compute_blob = None
-    count_oid = 0
-    count_blobs = 0
-    filename_count = 1
-    sql = None
-    os.makedirs(opts.output)
-    shutil.copyfile(
-        pkg_resources.resource_filename('zodbbrowser', 'sql.sh'),
-        os.path.join(os.path.join(opts.output, 'sql.sh')))
-    os.makedirs(os.path.join(opts.output, 'todo'))
+    count = {'oids': 0, 'blobs': 0}
     if blobs:
-        compute_blob = ZODB.blob.FilesystemHelper(
-            opts.blobs).layout.oid_to_path
+        compute_blob = layout.oid_to_path
         shell = open(os.path.join(opts.output, 'blobs.sh'), 'w')
         shell.write('#!/usr/bin/env bash\n')
         shell.write('if ! test -d 0x00; then\n')
@@ -89,29 +225,37 @@ def main(args=None):
         shell.write('fi\n')
     else:
         print 'Warning: no blobs detected.'
-    for oid in refs.getUnUsedOIDs():
-        count_oid += 1
-        if sql is None:
-            sql = open(os.path.join(
-                opts.output,
-                'todo',
-                'pack-{:06}.sql'.format(filename_count)), 'w')
-            filename_count += 1
-            sql.write('BEGIN;\n')
-        sql.write('DELETE FROM object_state WHERE zoid = {};\n'.format(oid))
-        if count_oid and count_oid % opts.lines == 0:
-            sql.write('COMMIT;\n')
-            sql.close()
-            sql = None
-        if compute_blob is not None:
-            blob = compute_blob(ZODB.utils.p64(oid))
-            if blob in blobs:
-                count_blobs += 1
-                blobs.remove(blob)
-                shell.write('rm -rf {}\n'.format(blob))
-    if sql is not None:
-        sql.write('COMMIT;\n')
-        sql.close()
+
+    def unused_oids():
+        for oid in refs.getUnUsedOIDs(in_memory=opts.in_memory):
+            count['oids'] += 1
+            if compute_blob is not None:
+                if oid in blobs:
+                    count['blobs'] += 1
+                    blobs.remove(oid)
+                    shell.write('rm -rf {}\n'.format(
+                        compute_blob(ZODB.utils.p64(oid))))
+            yield oid
+
+    if opts.execute:
+        # a checkpoint is only good for the oids it was saved for, which
+        # change whenever the reference database is updated
+        last_tid = refs.getLastTransaction()
+        executor = PackExecutor(
+            psycopg2.connect(opts.execute), paramstyle=psycopg2.paramstyle,
+            target_latency=opts.target_latency, pause=opts.pause,
+            checkpoint=os.path.join(opts.output, 'checkpoint'),
+            source='' if last_tid is None else ZODB.utils.tid_repr(last_tid),
+            progress=report_progress)
+        try:
+            executor.readCheckpoint()
+        except ValueError as error:
+            parser.error(error.args[0])
+        executor.run(unused_oids())
+    else:
+        write_sql_files(unused_oids(), opts.output, opts.lines,
+                        opts.statement_size)
     if compute_blob is not None:
         shell.close()
-    print 'Found {} objects and {} blobs.'.format(count_oid, count_blobs)
+    print 'Found {} objects and {} blobs.'.format(count['oids'],
+                                                  count['blobs'])
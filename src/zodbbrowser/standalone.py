@@ -29,12 +29,18 @@ from zope.event import notify
 from zope.exceptions import exceptionformatter
 import zope.app.component.hooks
 
+from zodbbrowser import cache
+from zodbbrowser.browser import closeAllThreadConnections
 from zodbbrowser.state import monkeypatch_provides
 from zodbbrowser.references import ReferencesDatabase
 from zodbbrowser.interfaces import IReferencesDatabase
 
 log = logging.getLogger("zodbbrowser")
 
+# ZODB's default of 400 objects per connection is too small for browsing
+# large trees
+CACHE_SIZE = 5000
+
 SCHEMA_XML = """
 <schema>
   <import package="ZODB"/>
@@ -167,6 +173,7 @@ def stop_serving():
     task_dispatcher.shutdown(False)
     task_dispatcher = None
     asyncore.close_all()
+    closeAllThreadConnections()
     getUtility(IDatabase, '<target>').close()
 
 
@@ -176,6 +183,19 @@ def monkeypatch_error_formatting():
     traceback.print_exception = exceptionformatter.print_exception
 
 
+def add_zeo_options(parser):
+    """Add the ZEO client cache options understood by open_database."""
+    parser.add_option('--zeo-cache-size', metavar='MB', type='int',
+                      help='size of the ZEO client cache'
+                      ' (default: the ZEO default)')
+    parser.add_option('--zeo-client', metavar='NAME',
+                      help='keep the ZEO client cache in a persistent file'
+                      ' with this name')
+    parser.add_option('--zeo-var', metavar='DIR',
+                      help='directory for the persistent ZEO client cache'
+                      ' (default: current directory)')
+
+
 def open_database(opts):
     if opts.db and opts.zeo:
         raise ValueError('you specified both ZEO and FileStorage; pick one')
@@ -185,6 +205,15 @@ def open_database(opts):
         raise ValueError('you specified both ZConfig and ZEO; pick one')
     if opts.storage and not opts.zeo:
         raise ValueError('a ZEO storage was specified without ZEO connection')
+    zeo_cache_size = getattr(opts, 'zeo_cache_size', None)
+    zeo_client = getattr(opts, 'zeo_client', None)
+    zeo_var = getattr(opts, 'zeo_var', None)
+    if (zeo_cache_size is not None or zeo_client or zeo_var) and not opts.zeo:
+        raise ValueError('ZEO cache options were specified without ZEO'
+                         ' connection')
+    if zeo_var and not zeo_client:
+        raise ValueError('a ZEO cache directory was specified without'
+                         ' a ZEO client name')
 
     if opts.db:
         filename = opts.db
@@ -214,8 +243,18 @@ def open_database(opts):
             zeo_storage = opts.storage
         else:
             zeo_storage = '1'
+        kwargs = {}
+        if zeo_cache_size is not None:
+            kwargs['cache_size'] = zeo_cache_size * cache.MEGABYTES
+        if zeo_client:
+            # a named client keeps its cache in a file that survives
+            # restarts, so it need not be refilled from the server
+            kwargs['client'] = zeo_client
+            if zeo_var:
+                kwargs['var'] = zeo_var
         db = DB(ClientStorage(
-            zeo_address, storage=zeo_storage, read_only=opts.readonly))
+            zeo_address, storage=zeo_storage, read_only=opts.readonly,
+            **kwargs))
     elif opts.config:
         db = databaseFromFile(open(opts.config))
     else:
@@ -241,6 +280,7 @@ def main(args=None, start_serving=True):
                       ' (host:port or socket name)')
     parser.add_option('--storage', metavar='NAME',
                       help='connect to given ZEO storage')
+    add_zeo_options(parser)
     parser.add_option('--listen', metavar='ADDRESS',
                       help='specify port (or host:port) to listen on',
                       default='localhost:8070')
@@ -252,6 +292,22 @@ def main(args=None, start_serving=True):
     parser.add_option('--rw', action='store_false', dest='readonly',
                       default=True,
                       help='open the database read-write (default: read-only)')
+    parser.add_option('--state-cache-size', metavar='MB', type='int',
+                      default=cache.MAX_STATE_PICKLES_SIZE // cache.MEGABYTES,
+                      help='memory to use for caching historical object'
+                      ' states (default: %default MB)')
+    parser.add_option('--pool-size', metavar='N', type='int',
+                      help='number of database connections to keep open;'
+                      ' every one of the %d server threads keeps one'
+                      ' (default: 7, or as set by --config)' % Options.threads)
+    parser.add_option('--cache-size', metavar='N', type='int',
+                      help='number of objects to keep in the cache of every'
+                      ' connection (default: %d, or as set by --config)'
+                      % CACHE_SIZE)
+    parser.add_option('--cache-size-mb', metavar='MB', type='int',
+                      help='memory limit for the object cache of every'
+                      ' connection (default: no limit, or as set by'
+                      ' --config)')
     opts, args = parser.parse_args(args)
 
     options = Options()
@@ -272,6 +328,8 @@ def main(args=None, start_serving=True):
     if len(args) > 1:
         parser.error('too many arguments')
 
+    cache.setStatePicklesCacheSize(opts.state_cache_size * cache.MEGABYTES)
+
     if len(args) == 1:
         opts.db = args[0]
     else:
@@ -289,16 +347,29 @@ def main(args=None, start_serving=True):
         db = open_database(opts)
     except ValueError as error:
         parser.error(error.args[0])
+    # don't override what the --config file says unless asked to
+    if opts.cache_size is None and not opts.config:
+        opts.cache_size = CACHE_SIZE
+    if opts.pool_size is not None:
+        db.setPoolSize(opts.pool_size)
+    if opts.cache_size is not None:
+        db.setCacheSize(opts.cache_size)
+    if opts.cache_size_mb is not None:
+        db.setCacheSizeBytes(opts.cache_size_mb * cache.MEGABYTES)
     provideUtility(db, IDatabase, name='<target>')
 
     # Optionaly load references
     if opts.load:
         try:
-            references = ReferencesDatabase(opts.load)
+            references = ReferencesDatabase(opts.load, readonly=True)
         except ValueError as error:
             parser.error(error.args[0])
         if references.checkDatabase():
             provideUtility(references, IReferencesDatabase)
+        elif references.needsMigration():
+            log.error("Reference database is in an old format, skipping it."
+                      " Convert it with zodbcheck --save-references %s"
+                      " --migrate.", opts.load)
         else:
             log.error("Reference database not initialized, skipping it.")
 
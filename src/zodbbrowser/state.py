@@ -28,8 +28,9 @@ try:
 except ImportError:
     from zope.app.container.contained import ContainedProxy # BBB
 
-from zodbbrowser.interfaces import IStateInterpreter, IObjectHistory
+from zodbbrowser.interfaces import IStateInterpreter
 from zodbbrowser.interfaces import HistoryMissingError
+from zodbbrowser.history import getObjectHistory
 
 
 log = logging.getLogger(__name__)
@@ -79,7 +80,7 @@ class ZodbObjectState(object):
     def __init__(self, obj, tid=None, _history=None):
         self.obj = removeAllProxies(obj)
         if _history is None:
-            _history = IObjectHistory(self.obj)
+            _history = getObjectHistory(self.obj)
         else:
             assert _history._obj is self.obj
         self.history = _history
@@ -243,7 +244,7 @@ class SampleContainerState(GenericState):
         # OOBTree -- SampleContainer itself uses a plain Python dict, but
         # subclasses are supposed to overwrite the _newContainerData() method
         # and use something persistent.
-        loadedstate = IObjectHistory(data).loadState(self.tid)
+        loadedstate = getObjectHistory(data).loadState(self.tid)
         return getMultiAdapter((data, loadedstate, self.tid),
                                IStateInterpreter).listItems()
 
@@ -260,11 +261,11 @@ class OrderedContainerState(GenericState):
         container = OrderedContainer()
         container.__setstate__(self.state)
         if isinstance(container._data, PersistentDict):
-            old_data_state = IObjectHistory(container._data).loadState(self.tid)
+            old_data_state = getObjectHistory(container._data).loadState(self.tid)
             container._data = PersistentDict()
             container._data.__setstate__(old_data_state)
         if isinstance(container._order, PersistentList):
-            old_order_state = IObjectHistory(container._order).loadState(self.tid)
+            old_order_state = getObjectHistory(container._order).loadState(self.tid)
             container._order = PersistentList()
             container._order.__setstate__(old_order_state)
         return container.items()
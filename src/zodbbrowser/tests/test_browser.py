@@ -2,14 +2,18 @@ import unittest
 import transaction
 import sys
 import gc
+import threading
 import json
+from cgi import escape
 
 from ZODB.utils import u64, p64, tid_repr, oid_repr
 from ZODB.interfaces import IDatabase
+from persistent.mapping import PersistentMapping
 from zope.app.container.btree import BTreeContainer
 from zope.app.container.interfaces import IContained
 from zope.app.testing import setup
 from zope.component import provideAdapter, getGlobalSiteManager
+from zope.exceptions.interfaces import UserError
 from zope.interface import implements
 from zope.publisher.browser import TestRequest
 from zope.traversing.interfaces import IContainmentRoot
@@ -17,8 +21,15 @@ from zope.security.checker import ProxyFactory
 
 from zodbbrowser.state import GenericState, ZodbObjectState
 from zodbbrowser.browser import ZodbObjectAttribute, ZodbInfoView
+from zodbbrowser.browser import ZodbHistoryView
 from zodbbrowser.browser import getObjectType, getObjectTypeShort
-from zodbbrowser.history import ZodbObjectHistory
+from zodbbrowser.browser import getObjectPath, getAncestry
+from zodbbrowser.browser import getThreadConnection, closeThreadConnection
+from zodbbrowser.browser import closeAllThreadConnections
+from zodbbrowser.history import ZodbObjectHistory, ZodbHistory
+from zodbbrowser.history import getObjectHistory, historyCache
+from zodbbrowser.interfaces import IDatabaseHistory
+from zodbbrowser.cache import getDiffCache, getPathCache, LRUCache
 from zodbbrowser.testing import SimpleValueRenderer
 
 from realdb import RealDatabaseTest
@@ -29,17 +40,23 @@ class DatabaseStub(object):
 
     opened = 0
 
-    def open(self):
+    def open(self, at=None):
         self.opened += 1
-        return ConnectionStub(self)
+        return ConnectionStub(self, at)
 
 
 class ConnectionStub(object):
-    def __init__(self, db):
-        self.db = db
+    def __init__(self, db, at=None):
+        self._db = db
+        self.at = at
+        self.opened = True
+
+    def db(self):
+        return self._db
 
     def close(self):
-        self.db.opened -= 1
+        self._db.opened -= 1
+        self.opened = None
 
 
 class RootFolderStub(BTreeContainer):
@@ -135,6 +152,16 @@ class TestZodbInfoViewWithRealDb(RealDatabaseTest):
         request.annotations['ZODB.interfaces.IConnection'] = self.root._p_jar
         view = self._zodbInfoView(None, request)
 
+    def testCallCachesObjectHistories(self):
+        view = ZodbInfoView(self.root, TestRequest())
+        seen = []
+        view.template = lambda: seen.append(
+            getObjectHistory(self.root['stub']) is
+            getObjectHistory(self.root['stub']))
+        view()
+        self.assertEquals(seen, [True])
+        self.assertEquals(len(view.history_cache), 1)
+
     def testGetJar(self):
         view = ZodbInfoView(self.root, TestRequest())
         self.assertEquals(view.jar, self.root._p_jar)
@@ -251,9 +278,235 @@ class TestZodbInfoViewWithRealDb(RealDatabaseTest):
         view = ZodbInfoView(self.root, TestRequest(form={'tid': '2'}))
         self.assertEquals(view.getUrl(1), '@@zodbbrowser?oid=0x1&tid=2')
 
+    def _commitChanges(self, n):
+        for i in range(n):
+            self.root['stub'].counter = i
+            transaction.commit()
+
+    def testListHistory(self):
+        self._commitChanges(6)
+        provideAdapter(SimpleValueRenderer)
+        view = self._zodbInfoView(self.root['stub'], TestRequest())
+        view.history_size = 2
+        history = view.listHistory()
+        self.assertEquals([h['latest'] for h in history], [True, False])
+        # without loading all of the revisions they are numbered back from
+        # the latest one
+        self.assertEquals([h['index'] for h in history], [-1, -2])
+        self.assertEquals(view.history.knownLength(), None)
+        self.assertEquals([h['index'] for h in view.listHistory(2, 4)],
+                          [-3, -4])
+        history = view.listHistory(2, 4)
+        self.assertEquals([h['latest'] for h in history], [False, False])
+        self.assertEquals([h['index'] for h in view.listHistory(6, 8)], [1])
+        self.assertEquals([h['index'] for h in view.listHistory(2, 4)], [5, 4])
+
+    def testListHistoryNumbersFromCachedHistory(self):
+        self._commitChanges(6)
+        provideAdapter(SimpleValueRenderer)
+        total = len(list(ZodbObjectHistory(self.root['stub'])))
+        view = self._zodbInfoView(self.root['stub'], TestRequest())
+        view.history_size = 2
+        self.assertEquals([h['index'] for h in view.listHistory()],
+                          [total, total - 1])
+
+    def testListHistoryLoadsOnlyLatestRevisions(self):
+        self._commitChanges(30)
+        provideAdapter(SimpleValueRenderer)
+        sizes = []
+        history = self.storage.history
+
+        def countingHistory(oid, size=1):
+            sizes.append(size)
+            return history(oid, size=size)
+
+        self.storage.history = countingHistory
+        view = self._zodbInfoView(self.root['stub'], TestRequest())
+        self.assertEquals(len(view.listHistory()), 20)
+        self.assertNotEquals(view.getMoreHistory(20), None)
+        self.assertEquals(sizes, [20])
+
+    def testInvalidHistorySize(self):
+        view = ZodbInfoView(self.root['stub'],
+                            TestRequest(form={'history_size': 'lots'}))
+        view.template = lambda: ''
+        self.assertRaises(UserError, view)
+
+    def testHistorySizeIncludesRequestedRevision(self):
+        self._commitChanges(6)
+        tid = ZodbObjectHistory(self.root['stub'])[4]['tid']
+        view = ZodbInfoView(self.root['stub'],
+                            TestRequest(form={'tid': tid_repr(tid)}))
+        view.history_page_size = 2
+        view.template = lambda: ''
+        view()
+        self.assertEquals(view.history_size, 5)
+
+    def testGetMoreHistory(self):
+        self._commitChanges(6)
+        view = self._zodbInfoView(self.root['stub'], TestRequest())
+        view.history_page_size = 3
+        oid = u64(self.root['stub']._p_oid)
+        self.assertEquals(view.getMoreHistory(3), dict(
+            href='@@zodbbrowser?oid=0x%x&history_size=6' % oid,
+            ajax_url='@@zodbbrowser_history_ajax?oid=0x%x&start=3&stop=6'
+                     % oid))
+        self.assertEquals(view.getMoreHistory(8), None)
+        # there might have been more
+        self.assertNotEquals(view.getMoreHistory(6), None)
+        # now we've seen the whole history
+        self.assertEquals(view.getMoreHistory(7), None)
+
+    def testHistoryAjax(self):
+        self._commitChanges(6)
+        setup.placelessSetUp()
+        self.addCleanup(setup.placelessTearDown)
+        setup.setUpTraversal()
+        provideAdapter(GenericState)
+        provideAdapter(ZodbObjectHistory)
+        provideAdapter(SimpleValueRenderer)
+        view = ZodbInfoView(self.root['stub'], TestRequest())
+        view.history_page_size = 3
+        view.supportsUndo = False # SimpleValueRenderer shows raw tids
+        html = view.history_ajax('3', '6')
+        tids = [u64(d['tid']) for d in ZodbObjectHistory(self.root['stub'])]
+        self.assertTrue('id="tid%d"' % tids[3] in html)
+        self.assertTrue('id="tid%d"' % tids[5] in html)
+        self.assertFalse('id="tid%d"' % tids[2] in html)
+        self.assertFalse('id="tid%d"' % tids[6] in html)
+        self.assertTrue('history_size=9' in html)
+        self.assertRaises(UserError, view.history_ajax, '3', 'x')
+
+    def testListHistoryComparesOnlyLatestRevisions(self):
+        self._commitChanges(6)
+        provideAdapter(SimpleValueRenderer)
+        view = self._zodbInfoView(self.root['stub'], TestRequest())
+        view.history_diffs_expanded = 2
+        history = view.listHistory(0, 4)
+        self.assertEquals([h['diff'] is not None for h in history],
+                          [True, True, False, False])
+        self.assertEquals(history[3]['diff_url'],
+                          '@@zodbbrowser_diff?oid=0x%x&tid=0x%x'
+                          % (u64(self.root['stub']._p_oid), history[3]['utid']))
+
+    def testGetDiff(self):
+        self._commitChanges(2)
+        provideAdapter(SimpleValueRenderer)
+        view = self._zodbInfoView(self.root['stub'], TestRequest())
+        view.supportsUndo = False # SimpleValueRenderer shows raw tids
+        tid = view.history[0]['tid']
+        error, diff = view.getDiff(tid)
+        self.assertEquals(error, None)
+        self.assertTrue('<strong>counter</strong>: changed to 1' in diff, diff)
+        diffs = getDiffCache(self.storage)
+        self.assertEquals(diffs.get((self.root['stub']._p_oid, tid,
+                                     view.history[1]['tid'])),
+                          (error, diff))
+        view._loadRevision = None # must not be called
+        self.assertEquals(view.getDiff(tid), (error, diff))
+
+    def testGetDiffOfFirstRevision(self):
+        provideAdapter(SimpleValueRenderer)
+        view = self._zodbInfoView(self.root['stub'], TestRequest())
+        view.supportsUndo = False
+        error, diff = view.getDiff(view.history[0]['tid'])
+        self.assertTrue('<strong>_SampleContainer__data</strong>: added'
+                        in diff, diff)
+
+    def testDiffAjax(self):
+        self._commitChanges(2)
+        provideAdapter(SimpleValueRenderer)
+        oid = self.root['stub']._p_oid
+        view = ZodbInfoView(self.root, TestRequest(form={'oid': oid_repr(oid)}))
+        view.supportsUndo = False
+        tid = ZodbObjectHistory(self.root['stub'])[0]['tid']
+        html = view.diff_ajax(tid_repr(tid))
+        self.assertTrue('<strong>counter</strong>: changed to 1' in html, html)
+
+    def testDiffAjaxBadTid(self):
+        oid = self.root['stub']._p_oid
+        view = ZodbInfoView(self.root, TestRequest(form={'oid': oid_repr(oid)}))
+        self.assertRaises(UserError, view.diff_ajax, 'junk')
+        self.assertRaises(UserError, view.diff_ajax, '0')
+        self.assertRaises(UserError, view.diff_ajax, '-0x1')
+        self.assertRaises(UserError, view.diff_ajax, '0x10000000000000000')
+
+    def testListAttributesPrefetchesLinkedObjects(self):
+        tid = ZodbObjectHistory(self.root).lastChange()
+        view = self._zodbInfoView(self.root,
+                                  TestRequest(form={'tid': tid_repr(tid)}))
+        with historyCache(view.history_cache):
+            view.listAttributes()
+            history = getObjectHistory(self.root['stub'])
+            self.assertEquals(history._revisions.keys(), [tid])
+
+    def testViewOldRevisionInHistoricalConnection(self):
+        registry = getGlobalSiteManager()
+        registry.registerUtility(self.db, IDatabase, name='<target>')
+        self.addCleanup(registry.unregisterUtility,
+                        self.db, IDatabase, name='<target>')
+        stub = self.root['stub']
+        stub.counter = 1
+        transaction.commit()
+        tid = ZodbObjectHistory(stub).lastChange()
+        stub.counter = 2
+        transaction.commit()
+        request = TestRequest(form={'oid': oid_repr(stub._p_oid),
+                                    'tid': tid_repr(tid)})
+        view = self._zodbInfoView(None, request)
+        self.assertEquals(view.jar.before, p64(u64(tid) + 1))
+        self.assertEquals(view.obj.counter, 1)
+        self.assertEquals(view.state.tid, tid)
+        self.assertFalse(view.readonly)
+
+    def testViewObjectMissingFromHistoricalConnection(self):
+        registry = getGlobalSiteManager()
+        registry.registerUtility(self.db, IDatabase, name='<target>')
+        self.addCleanup(registry.unregisterUtility,
+                        self.db, IDatabase, name='<target>')
+        tid = ZodbObjectHistory(self.root).lastChange()
+        self.root['newer'] = PersistentMapping()
+        transaction.commit()
+        request = TestRequest(form={'oid': oid_repr(self.root['newer']._p_oid),
+                                    'tid': tid_repr(tid)})
+        view = self._zodbInfoView(None, request)
+        self.assertEquals(view.obj._p_oid, self.root['newer']._p_oid)
+        self.assertEquals(view.obj._p_jar.before, None)
+
+    def testGetObjectPath(self):
+        item = self.root['root']['item']
+        tid = ZodbObjectHistory(item).lastChange()
+        self.assertEquals(getObjectPath(item, tid), '/item')
+        paths = getPathCache(self.storage)
+        self.assertEquals(paths.get((u64(self.root['root']._p_oid), tid)),
+                          ((u64(self.root['root']._p_oid), True, None,
+                            False),))
+        hits = paths.hits
+        self.assertEquals(getObjectPath(item, tid), '/item')
+        self.assertEquals(paths.hits, hits + 1)
+
+    def testGetBreadcrumbsUsesPathCache(self):
+        item = self.root['root']['item']
+        tid = self.storage.lastTransaction()
+        view = self._zodbInfoView(item,
+                                  TestRequest(form={'tid': tid_repr(tid)}))
+        self.assertEquals(view.getPath(), '/item')
+        self.assertEquals(getPathCache(self.storage).get(
+            (u64(item._p_oid), tid))[0][2], 'item')
+
+    def testGetBreadcrumbsDoesNotCacheLatestPath(self):
+        item = self.root['root']['item']
+        paths = getPathCache(self.storage)
+        paths.clear()
+        view = self._zodbInfoView(item, TestRequest())
+        self.assertEquals(view.getPath(), '/item')
+        self.assertEquals(len(paths), 0)
+
 
 class ZodbObjectStateStub(object):
 
+    requestedTid = None
+
     def __init__(self, context):
         self.context = context
 
@@ -351,6 +604,31 @@ class TestZodbInfoViewBreadcrumbs(unittest.TestCase):
                           [('/', '@@zodbbrowser?oid=0x1'),
                            ('???', '@@zodbbrowser?oid=0x37'), ])
 
+    def test_getAncestry(self):
+        state = ZodbObjectStateStub(self.foobar)
+        self.assertEquals(getAncestry(state),
+                          ((32, False, 'bar', True),
+                           (27, False, 'foo', True),
+                           (1, True, None, False)))
+
+    def test_getAncestry_cached(self):
+        paths = LRUCache(10)
+        ancestry = getAncestry(ZodbObjectStateStub(self.foobar), 'tid', paths)
+        self.assertEquals(paths.get((32, 'tid')), ancestry)
+        self.assertEquals(paths.get((27, 'tid')), ancestry[1:])
+        self.assertEquals(paths.get((1, 'tid')), ancestry[2:])
+        self.assertEquals(paths.get((27, 'other')), None)
+        # the cached ancestry of the parent is reused
+        paths.pop((1, 'tid'))
+        foobaz = PersistentStub()
+        foobaz._p_oid = p64(33)
+        self.foo['baz'] = foobaz
+        state = ZodbObjectStateStub(foobaz)
+        state.getParentState = None # must not be called
+        self.assertEquals(getAncestry(state, 'tid', paths),
+                          ((33, False, 'baz', True),) + ancestry[1:])
+        self.assertEquals(paths.get((1, 'tid')), None)
+
 
 class TestZodbInfoView(unittest.TestCase):
 
@@ -374,12 +652,62 @@ class TestZodbInfoView(unittest.TestCase):
         registry.registerUtility(stub_db, IDatabase, name='<target>')
         self.addCleanUp(registry.unregisterUtility,
                         stub_db, IDatabase, name='<target>')
+        self.addCleanUp(closeThreadConnection)
         view = ZodbInfoView(object(), TestRequest())
-        self.assertEquals(view.jar.db, stub_db)
+        self.assertEquals(view.jar.db(), stub_db)
+        jar = view.jar
         del view
         gc.collect()
+        # the connection stays open for the next request in this thread
+        self.assertEquals(stub_db.opened, 1)
+        view = ZodbInfoView(object(), TestRequest())
+        self.assertTrue(view.jar is jar)
+        closeThreadConnection()
         self.assertEquals(stub_db.opened, 0)
 
+    def testCloseAllThreadConnections(self):
+        stub_db = DatabaseStub()
+        thread = threading.Thread(target=getThreadConnection, args=(stub_db,))
+        thread.start()
+        thread.join()
+        getThreadConnection(stub_db)
+        self.assertEquals(stub_db.opened, 2)
+        closeAllThreadConnections()
+        self.assertEquals(stub_db.opened, 0)
+        # a closed connection is replaced by a new one
+        self.assertTrue(getThreadConnection(stub_db).opened)
+        closeThreadConnection()
+        self.assertEquals(stub_db.opened, 0)
+
+    def testGetJar_historical_connections_are_closed(self):
+        stub_db = DatabaseStub()
+        registry = getGlobalSiteManager()
+        registry.registerUtility(stub_db, IDatabase, name='<target>')
+        self.addCleanUp(registry.unregisterUtility,
+                        stub_db, IDatabase, name='<target>')
+        view = ZodbInfoView(object(), TestRequest(form={'tid': '0x10'}))
+        view.jar
+        del view
+        gc.collect()
+        self.assertEquals(stub_db.opened, 0)
+
+    def testGetJar_pins_connection_to_requested_tid(self):
+        stub_db = DatabaseStub()
+        registry = getGlobalSiteManager()
+        registry.registerUtility(stub_db, IDatabase, name='<target>')
+        self.addCleanUp(registry.unregisterUtility,
+                        stub_db, IDatabase, name='<target>')
+        self.addCleanUp(closeThreadConnection)
+        view = ZodbInfoView(object(), TestRequest(form={'tid': '0x10'}))
+        self.assertEquals(view.jar.at, p64(16))
+        view = ZodbInfoView(object(), TestRequest(form={'tid': '0x10',
+                                                        'ROLLBACK': 'Rollback'}))
+        self.assertEquals(view.jar.at, None)
+        view = ZodbInfoView(object(), TestRequest(form={'tid': 'junk'}))
+        self.assertEquals(view.jar.at, None)
+        view = ZodbHistoryView(object(), TestRequest(form={'tid': '0x10'}))
+        self.assertEquals(view.jar.at, None)
+
     def test_getPath(self):
         view = ZodbInfoView(None, None)
         view.getBreadcrumbs = lambda: [('/', None), ('foo', None),
@@ -451,6 +779,125 @@ class TestZodbInfoView(unittest.TestCase):
                           "'something else'")
 
 
+class DatabaseHistoryStub(object):
+
+    def __init__(self, tids):
+        self.tids = tids
+
+    def __len__(self):
+        return len(self.tids)
+
+    def positionOf(self, tid):
+        return self.tids.index(tid)
+
+    def tidAtOrBefore(self, tid):
+        earlier = [t for t in self.tids if t <= tid]
+        return earlier[-1] if earlier else None
+
+
+class TestZodbHistoryView(unittest.TestCase):
+
+    def test_findPage(self):
+        view = ZodbHistoryView(None, None)
+        view.history = DatabaseHistoryStub([p64(n) for n in range(10, 22)])
+        view.page_size = 5
+        self.assertEquals(view.findPage(p64(21)), 0)
+        self.assertEquals(view.findPage(p64(17)), 0)
+        self.assertEquals(view.findPage(p64(16)), 1)
+        self.assertEquals(view.findPage(p64(10)), 2)
+        self.assertEquals(view.findPage(p64(99)), 0)
+
+    def test_findPage_unknown_tid(self):
+        view = ZodbHistoryView(None, None)
+        view.history = DatabaseHistoryStub([p64(n) for n in range(10, 22, 2)])
+        view.page_size = 2
+        self.assertEquals(view.findPage(p64(13)), 2)
+        self.assertEquals(view.findPage(p64(5)), 0)
+
+
+class EscapedReprRenderer(SimpleValueRenderer):
+
+    def render(self, tid=None):
+        return escape(repr(self.context))
+
+
+class VanishingHistoryStub(object):
+    """As if the storage was packed after we looked up a transaction."""
+
+    def positionOf(self, tid):
+        return 0
+
+    def __getitem__(self, item):
+        return []
+
+
+class TestZodbHistoryViewWithRealDb(RealDatabaseTest):
+
+    def setUp(self):
+        RealDatabaseTest.setUp(self)
+        setup.placelessSetUp()
+        setup.setUpTraversal()
+        provideAdapter(GenericState)
+        provideAdapter(ZodbObjectHistory)
+        provideAdapter(EscapedReprRenderer)
+        provideAdapter(ZodbHistory)
+        root = self.conn.root()
+        root['small'] = PersistentMapping()
+        transaction.commit()
+        for n in range(7):
+            root['big%d' % n] = PersistentMapping()
+        transaction.commit()
+        self.tids = [t.tid for t in self.storage.iterator()]
+
+    def tearDown(self):
+        setup.placelessTearDown()
+        RealDatabaseTest.tearDown(self)
+
+    def createView(self):
+        view = ZodbHistoryView(self.conn.root(), TestRequest())
+        view.jar = self.conn
+        view.supportsUndo = False
+        return view
+
+    def test_listHistory(self):
+        view = self.createView()
+        view.history = IDatabaseHistory(self.conn)
+        view.page = 0
+        view.first_idx, view.last_idx = 1, 3
+        big, small = view.listHistory()
+        self.assertEquals(small['summary'][:16], '2 object records')
+        self.assertFalse(small['hidden'])
+        self.assertEquals(len(small['objects']), 2)
+        self.assertEquals(big['summary'][:16], '8 object records')
+        self.assertTrue(big['hidden'])
+        self.assertEquals(big['objects'], None)
+        self.assertEquals(big['objects_url'],
+                          '@@zodbbrowser_transaction_objects?tid=0x%x&start=0'
+                          % u64(self.tids[2]))
+
+    def test_objects_ajax(self):
+        view = self.createView()
+        view.objects_page_size = 5
+        html = view.objects_ajax(tid_repr(self.tids[2]))
+        self.assertEquals(html.count('<li>'), 5)
+        self.assertTrue('start=5' in html)
+        html = view.objects_ajax(tid_repr(self.tids[2]), '5')
+        self.assertEquals(html.count('<li>'), 3)
+        self.assertFalse('more-objects' in html)
+
+    def test_objects_ajax_unknown_tid(self):
+        view = self.createView()
+        self.assertRaises(UserError, view.objects_ajax, '0x1')
+        self.assertRaises(UserError, view.objects_ajax, 'junk')
+        self.assertRaises(UserError, view.objects_ajax,
+                          tid_repr(self.tids[2]), 'junk')
+
+    def test_getTransaction_gone(self):
+        view = self.createView()
+        view.history = VanishingHistoryStub()
+        self.assertRaises(UserError, view._getTransaction, self.tids[2])
+
+
 class TestHelperFunctions(unittest.TestCase):
 
     def test_getObjectType(self):
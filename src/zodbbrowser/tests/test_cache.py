@@ -1,7 +1,18 @@
 import unittest
 import time
 
+import transaction
+from persistent.dict import PersistentDict
+
+from ZODB.utils import p64, u64
+
 from zodbbrowser.cache import expired, MINUTES
+from zodbbrowser.cache import getStorageTids, STORAGE_TIDS, isPacked
+from zodbbrowser.cache import LRUCache, getHistoryRecords, HISTORY_RECORDS
+from zodbbrowser.cache import HistoryRecordCache
+from zodbbrowser.cache import loadSerial, setStatePicklesCacheSize
+from zodbbrowser.cache import STATE_PICKLES, loadBefore, getDiffCache
+from zodbbrowser.tests.realdb import RealDatabaseTest
 
 
 class TestCache(unittest.TestCase):
@@ -13,5 +24,293 @@ class TestCache(unittest.TestCase):
         self.assertTrue(expired({'last_update': now - 1 - 5 * MINUTES}, 5 * MINUTES))
 
 
+class TransactionStub(object):
+
+    def __init__(self, tid):
+        self.tid = tid
+
+
+class StorageStub(object):
+
+    def __init__(self, tids):
+        self.tids = [p64(n) for n in tids]
+        self.scanned = 0
+
+    def lastTransaction(self):
+        return self.tids[-1] if self.tids else p64(0)
+
+    def iterator(self, start=None):
+        for tid in self.tids:
+            if start is None or tid >= start:
+                self.scanned += 1
+                yield TransactionStub(tid)
+
+
+class ClosingIterator(object):
+
+    def __init__(self, records):
+        self.records = records
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def close(self):
+        self.closed = True
+
+
+class NonIterableStorageStub(object):
+
+    def __init__(self, last_transaction):
+        self.last_transaction = last_transaction
+
+    def lastTransaction(self):
+        return self.last_transaction
+
+
+class StorageStubWithIterator(object):
+
+    def __init__(self, iterator):
+        self.iterator = iterator
+
+
+class TestGetStorageTids(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = StorageStub(range(1, 11))
+
+    def test_initial_scan(self):
+        self.assertEqual(list(getStorageTids(self.storage)),
+                         self.storage.tids)
+        self.assertEqual(self.storage.scanned, 10)
+
+    def test_no_rescan_when_unchanged(self):
+        getStorageTids(self.storage)
+        getStorageTids(self.storage)
+        getStorageTids(self.storage, cache_for=0)
+        # the pack check looked at the first record only
+        self.assertEqual(self.storage.scanned, 11)
+
+    def test_new_transactions(self):
+        tids = getStorageTids(self.storage)
+        self.storage.tids.append(p64(11))
+        self.storage.scanned = 0
+        self.assertTrue(getStorageTids(self.storage) is tids)
+        self.assertEqual(list(tids), self.storage.tids)
+        # first record, last known record, new record
+        self.assertEqual(self.storage.scanned, 3)
+
+    def test_packed(self):
+        getStorageTids(self.storage)
+        del self.storage.tids[:3]
+        self.storage.scanned = 0
+        self.assertEqual(list(getStorageTids(self.storage, cache_for=0)),
+                         self.storage.tids)
+
+    def test_pack_check_closes_iterator(self):
+        iterators = []
+
+        def iterator(start=None):
+            iterators.append(ClosingIterator([TransactionStub(p64(1))]))
+            return iterators[-1]
+
+        self.assertFalse(isPacked(StorageStubWithIterator(iterator),
+                                  [p64(1)]))
+        self.assertTrue(iterators[0].closed)
+
+    def test_refresh_in_progress(self):
+        tids = getStorageTids(self.storage)
+        self.storage.tids.append(p64(11))
+        STORAGE_TIDS[self.storage]['lock'].acquire()
+        try:
+            self.assertEqual(len(getStorageTids(self.storage)), 10)
+        finally:
+            STORAGE_TIDS[self.storage]['lock'].release()
+        self.assertEqual(len(getStorageTids(self.storage)), 11)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = LRUCache(10)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 42), 42)
+        cache['a'] = 1
+        self.assertEqual(cache.get('a'), 1)
+        self.assertTrue('a' in cache)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_eviction(self):
+        cache = LRUCache(3)
+        for key in 'abc':
+            cache[key] = key
+        cache.get('a')
+        cache['d'] = 'd'
+        self.assertEqual(sorted(cache._data), ['a', 'c', 'd'])
+        self.assertEqual(cache.used, 3)
+
+    def test_sizeof(self):
+        cache = LRUCache(10, sizeof=len)
+        cache['a'] = 'x' * 4
+        cache['b'] = 'x' * 4
+        cache['a'] = 'x' * 5
+        self.assertEqual(cache.used, 9)
+        cache['c'] = 'x' * 3
+        self.assertEqual(sorted(cache._data), ['a', 'c'])
+        self.assertEqual(cache.used, 8)
+        cache['d'] = 'x' * 11
+        self.assertFalse('d' in cache)
+        self.assertEqual(cache.used, 8)
+
+    def test_resize(self):
+        cache = LRUCache(10)
+        for key in 'abcde':
+            cache[key] = key
+        cache.resize(2)
+        self.assertEqual(sorted(cache._data), ['d', 'e'])
+
+    def test_pop_clear(self):
+        cache = LRUCache(10)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a'), None)
+        cache.clear()
+        self.assertEqual((len(cache), cache.used), (0, 0))
+
+
+class TestGetHistoryRecords(RealDatabaseTest):
+
+    def setUp(self):
+        RealDatabaseTest.setUp(self)
+        self.root = self.conn.root()
+        self.root['a'] = PersistentDict()
+        self.root['b'] = PersistentDict()
+        transaction.commit()
+        self.loaded = []
+
+    def getHistory(self, obj):
+        oid = obj._p_oid
+
+        def load():
+            self.loaded.append(oid)
+            return self.storage.history(oid, size=999)
+
+        return getHistoryRecords(self.storage, oid, load)
+
+    def test_cached(self):
+        a = self.root['a']
+        history = self.getHistory(a)
+        self.assertTrue(self.getHistory(a) is history)
+        self.assertEqual(self.loaded, [a._p_oid])
+        self.assertEqual(HISTORY_RECORDS[self.storage].hits, 1)
+
+    def test_invalidation(self):
+        a, b = self.root['a'], self.root['b']
+        self.getHistory(a)
+        b_history = self.getHistory(b)
+        a['x'] = 1
+        transaction.commit()
+        self.assertEqual(len(self.getHistory(a)), 2)
+        self.assertTrue(self.getHistory(b) is b_history)
+        self.assertEqual(self.loaded, [a._p_oid, b._p_oid, a._p_oid])
+
+    def test_invalidation_without_iterator(self):
+        histories = HistoryRecordCache(10, p64(1))
+        histories['oid'] = ['h']
+        histories.invalidate(NonIterableStorageStub(p64(2)))
+        self.assertEqual(len(histories), 0)
+
+    def test_storage_without_lastTransaction(self):
+        history = getHistoryRecords(object(), 'oid', lambda: ['h'])
+        self.assertEqual(history, ['h'])
+
+
+class PickleStorageStub(object):
+
+    def __init__(self):
+        self.loaded = []
+
+    def loadSerial(self, oid, serial):
+        self.loaded.append((oid, serial))
+        return 'pickle of %s at %s' % (oid, serial)
+
+
+class TestLoadSerial(unittest.TestCase):
+
+    def tearDown(self):
+        setStatePicklesCacheSize(64 * 1024 * 1024)
+
+    def test_cached(self):
+        storage = PickleStorageStub()
+        self.assertEqual(loadSerial(storage, 'o1', 't1'), 'pickle of o1 at t1')
+        self.assertEqual(loadSerial(storage, 'o1', 't1'), 'pickle of o1 at t1')
+        self.assertEqual(loadSerial(storage, 'o1', 't2'), 'pickle of o1 at t2')
+        self.assertEqual(storage.loaded, [('o1', 't1'), ('o1', 't2')])
+        self.assertEqual(STATE_PICKLES[storage].used, 36)
+
+    def test_size_limit(self):
+        storage = PickleStorageStub()
+        setStatePicklesCacheSize(30)
+        loadSerial(storage, 'o1', 't1')
+        loadSerial(storage, 'o2', 't1')
+        loadSerial(storage, 'o1', 't1')
+        self.assertEqual(len(storage.loaded), 3)
+        setStatePicklesCacheSize(10)
+        self.assertEqual(len(STATE_PICKLES[storage]), 0)
+
+
+class PrefetchingStorageStub(object):
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.prefetched = []
+
+    def prefetch(self, oids, tid):
+        self.prefetched.append((oids, tid))
+
+    def loadBefore(self, oid, tid):
+        return self.storage.loadBefore(oid, tid)
+
+
+class TestGetDiffCache(unittest.TestCase):
+
+    def test_size_of_html(self):
+        storage = PickleStorageStub()
+        diffs = getDiffCache(storage)
+        diffs['oid', 'new', 'old'] = ('error', '<b>diff</b>')
+        self.assertEqual(diffs.used, len('<b>diff</b>'))
+        self.assertTrue(getDiffCache(storage) is diffs)
+
+
+class TestLoadBefore(RealDatabaseTest):
+
+    def setUp(self):
+        RealDatabaseTest.setUp(self)
+        self.root = self.conn.root()
+        self.a = self.root['a'] = PersistentDict()
+        transaction.commit()
+        self.tid = self.storage.lastTransaction()
+        self.a['x'] = 1
+        self.b = self.root['b'] = PersistentDict()
+        transaction.commit()
+
+    def test(self):
+        oids = [self.a._p_oid, self.b._p_oid]
+        result = loadBefore(self.storage, oids, self.tid)
+        self.assertEqual(result.keys(), [self.a._p_oid])
+        data, serial = result[self.a._p_oid]
+        self.assertEqual(serial, self.tid)
+        self.assertEqual(data, self.storage.loadSerial(self.a._p_oid,
+                                                       self.tid))
+
+    def test_prefetch(self):
+        storage = PrefetchingStorageStub(self.storage)
+        oids = [self.a._p_oid, self.b._p_oid]
+        loadBefore(storage, oids, self.tid)
+        self.assertEqual(storage.prefetched, [(oids, p64(u64(self.tid) + 1))])
+
+
 def test_suite():
     return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -4,11 +4,17 @@ import sys
 import transaction
 from persistent import Persistent
 from persistent.dict import PersistentDict
+from ZODB.utils import p64, u64
 from zope.interface.verify import verifyObject
+from zope.component import provideAdapter
+from zope.app.testing import setup
 
 from zodbbrowser.tests.realdb import RealDatabaseTest
-from zodbbrowser.history import ZodbObjectHistory
+from zodbbrowser.history import ZodbObjectHistory, ZodbHistory
+from zodbbrowser.history import ObjectHistoryCache, historyCache
+from zodbbrowser.history import getObjectHistory, prefetchStates
 from zodbbrowser.interfaces import IObjectHistory
+from zodbbrowser.cache import STATE_PICKLES
 
 
 class PersistentObject(Persistent):
@@ -40,6 +46,83 @@ class TestFileStorage(RealDatabaseTest):
         history = ZodbObjectHistory(obj)
         self.assertEquals(len(history), 11)
 
+    def test_slice(self):
+        obj = self.obj
+        for n in range(10):
+            obj[n] = n
+            transaction.commit()
+        expected = list(ZodbObjectHistory(obj))
+        history = ZodbObjectHistory(obj)
+        self.assertEquals(history.slice(0, 3), expected[0:3])
+        self.assertEquals(history.slice(2, 5), expected[2:5])
+        self.assertTrue(history._history is None)
+        self.assertEquals(history.slice(8, 20), expected[8:])
+        self.assertEquals(len(history._history), 11)
+        self.assertEquals(history.slice(5), expected[5:])
+
+    def test_history_records_shared_between_connections(self):
+        conn = self.db.open()
+        try:
+            history = ZodbObjectHistory(conn.get(self.obj._p_oid))
+            history._load()
+            records = history._history
+            history = ZodbObjectHistory(self.obj)
+            history._load()
+            self.assertTrue(history._history is records)
+        finally:
+            conn.close()
+
+    def test_state_pickles_shared_between_connections(self):
+        conn = self.db.open()
+        try:
+            tid = ZodbObjectHistory(self.obj).lastChange()
+            ZodbObjectHistory(conn.get(self.obj._p_oid))._loadSerial(tid)
+            ZodbObjectHistory(self.obj)._loadSerial(tid)
+            self.assertEquals(STATE_PICKLES[self.storage].hits, 1)
+        finally:
+            conn.close()
+
+    def test_lastChange_on_historical_connection(self):
+        obj = self.obj
+        for n in range(3):
+            obj[n] = n
+            transaction.commit()
+        tids = [d['tid'] for d in ZodbObjectHistory(obj)]
+        conn = self.db.open(at=tids[2])
+        try:
+            old = conn.get(obj._p_oid)
+            history = ZodbObjectHistory(old)
+            self.assertEquals(history.lastChange(tids[2]), tids[2])
+            self.assertEquals(history.loadState(tids[2]), {'data': {0: 0}})
+            self.assertTrue(history._history is None)
+            # the latest revision is not what this connection shows
+            self.assertEquals(history.lastChange(), tids[0])
+            self.assertEquals(len(history._history), 4)
+        finally:
+            conn.close()
+
+    def test_lastChange_without_history(self):
+        obj = self.obj
+        for n in range(3):
+            obj[n] = n
+            transaction.commit()
+        tids = [d['tid'] for d in ZodbObjectHistory(obj)]
+        history = ZodbObjectHistory(obj)
+        self.assertEquals(history.lastChange(), tids[0])
+        self.assertEquals(history.lastChange(tids[1]), tids[1])
+        self.assertEquals(history.lastChange(p64(u64(tids[1]) + 1)), tids[1])
+        self.assertEquals(history.loadState(tids[2]), {'data': {0: 0}})
+        self.assertTrue(history._history is None)
+        # the first adapter left the whole history in the cache
+        self.assertEquals(history.knownLength(), len(tids))
+
+    def test_lastChange_with_uncommitted_changes(self):
+        tid = ZodbObjectHistory(self.obj).lastChange()
+        self.obj[0] = 0
+        history = ZodbObjectHistory(self.obj)
+        self.assertEquals(history.lastChange(), tid)
+        self.assertEquals(history.knownLength(), 1)
+
 
 class TestLoadState(RealDatabaseTest):
 
@@ -73,6 +156,15 @@ class TestLoadState(RealDatabaseTest):
         state = ZodbObjectHistory(self.adam).loadState(tid)
         self.assertEquals(state, dict(laptop='ThinkPad T23'))
 
+    def test_lastChange(self):
+        history = ZodbObjectHistory(self.adam)
+        tids = [d['tid'] for d in history]
+        eve_tid = ZodbObjectHistory(self.eve)[0]['tid']
+        self.assertEquals(history.lastChange(), tids[0])
+        self.assertEquals(history.lastChange(tids[2]), tids[2])
+        self.assertEquals(history.lastChange(eve_tid), tids[2])
+        self.assertEquals(history.lastChange(p64(u64(tids[0]) + 1)), tids[0])
+
     def test_error_handling(self):
         from zodbbrowser.interfaces import HistoryMissingError
 
@@ -93,6 +185,102 @@ class TestLoadState(RealDatabaseTest):
         self.assertTrue(self.adam._p_changed)
 
 
+class TestObjectHistoryCache(RealDatabaseTest):
+
+    def setUp(self):
+        setup.placelessSetUp()
+        provideAdapter(ZodbObjectHistory)
+        RealDatabaseTest.setUp(self)
+        root = self.conn.root()
+        self.adam = root['adam'] = PersistentObject()
+        self.eve = root['eve'] = PersistentObject()
+        transaction.commit()
+
+    def tearDown(self):
+        RealDatabaseTest.tearDown(self)
+        setup.placelessTearDown()
+
+    def test_get(self):
+        cache = ObjectHistoryCache()
+        history = cache.get(self.adam)
+        self.assertTrue(isinstance(history, ZodbObjectHistory))
+        self.assertTrue(cache.get(self.adam) is history)
+        self.assertFalse(cache.get(self.eve) is history)
+        self.assertEquals(len(cache), 2)
+
+    def test_getObjectHistory_without_cache(self):
+        self.assertFalse(getObjectHistory(self.adam) is
+                         getObjectHistory(self.adam))
+
+    def test_getObjectHistory_with_cache(self):
+        with historyCache(ObjectHistoryCache()) as cache:
+            history = getObjectHistory(self.adam)
+            self.assertTrue(getObjectHistory(self.adam) is history)
+            self.assertEquals(len(cache), 1)
+        self.assertFalse(getObjectHistory(self.adam) is history)
+
+    def test_prefetchStates(self):
+        tid = ZodbObjectHistory(self.adam).lastChange()
+        self.adam.laptop = 'ThinkPad'
+        transaction.commit()
+        with historyCache(ObjectHistoryCache()):
+            prefetchStates([self.adam, self.eve], tid)
+            for obj in self.adam, self.eve:
+                history = getObjectHistory(obj)
+                history._load = None # must not be called
+                self.assertEquals(history.lastChange(tid), tid)
+                self.assertEquals(history.loadState(tid), {})
+
+    def test_prefetchStates_before_creation(self):
+        tid = ZodbObjectHistory(self.adam).lastChange()
+        cain = self.conn.root()['cain'] = PersistentObject()
+        transaction.commit()
+        with historyCache(ObjectHistoryCache()):
+            prefetchStates([cain], tid)
+            self.assertEquals(getObjectHistory(cain)._revisions, {})
+
+
+class TestZodbHistory(RealDatabaseTest):
+
+    def setUp(self):
+        RealDatabaseTest.setUp(self)
+        obj = self.conn.root()['obj'] = PersistentDict()
+        transaction.commit()
+        for n in range(10):
+            obj[n] = n
+            transaction.commit()
+        self.all_tids = [t.tid for t in self.storage.iterator()]
+
+    def test_tids(self):
+        history = ZodbHistory(self.conn)
+        self.assertEquals(len(history), 12)
+        self.assertEquals(list(history.tids), self.all_tids)
+
+    def test_slicing(self):
+        history = ZodbHistory(self.conn)
+        self.assertEquals([t.tid for t in history[3:7]], self.all_tids[3:7])
+        self.assertEquals([t.tid for t in history[8:20]], self.all_tids[8:])
+        self.assertEquals(list(history[5:5]), [])
+
+    def test_positionOf(self):
+        history = ZodbHistory(self.conn)
+        self.assertEquals(history.positionOf(self.all_tids[0]), 0)
+        self.assertEquals(history.positionOf(self.all_tids[7]), 7)
+        self.assertRaises(ValueError, history.positionOf,
+                          p64(u64(self.all_tids[7]) + 1))
+
+    def test_tidAtOrBefore(self):
+        history = ZodbHistory(self.conn)
+        tid = self.all_tids[7]
+        self.assertEquals(history.tidAtOrBefore(tid), tid)
+        self.assertEquals(history.tidAtOrBefore(p64(u64(tid) + 1)), tid)
+        self.assertEquals(history.tidAtOrBefore(p64(u64(tid) - 1)),
+                          self.all_tids[6])
+        self.assertEquals(history.tidAtOrBefore(p64(1)), None)
+        self.assertEquals(history.tidAtOrBefore(p64(2**63)),
+                          self.all_tids[-1])
+
+
 def test_suite():
     this = sys.modules[__name__]
     return unittest.defaultTestLoader.loadTestsFromModule(this)
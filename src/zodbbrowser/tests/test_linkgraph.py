@@ -0,0 +1,31 @@
+import unittest
+
+from zodbbrowser.linkgraph import LinkGraph
+
+
+class TestLinkGraph(unittest.TestCase):
+
+    def test_empty(self):
+        graph = LinkGraph([])
+        self.assertEqual(len(graph), 0)
+        self.assertEqual(list(graph.unreachable()), [])
+
+    def test_csr(self):
+        graph = LinkGraph([(0, 1), (0, 2), (1, -1), (2, 1), (5, -1)])
+        self.assertEqual(list(graph.nodes), [0, 1, 2, 5])
+        self.assertEqual(list(graph.offsets), [0, 2, 2, 3, 3])
+        self.assertEqual(list(graph.targets), [1, 2, 1])
+
+    def test_unreachable(self):
+        graph = LinkGraph([(0, 1), (1, 0), (1, 7), (3, 4), (4, 3), (5, -1),
+                           (7, 42)])
+        # 42 is missing, 3 and 4 only refer to each other
+        self.assertEqual(list(graph.unreachable()), [3, 4, 5])
+
+    def test_no_root(self):
+        graph = LinkGraph([(1, 2), (2, -1)])
+        self.assertEqual(list(graph.unreachable()), [1, 2])
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
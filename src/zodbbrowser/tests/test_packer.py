@@ -0,0 +1,137 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from zodbbrowser.packer import PackExecutor
+
+
+class Interrupted(Exception):
+    pass
+
+
+class ClockStub(object):
+
+    def __init__(self, step):
+        self.now = 0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+class TestPackExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-zodbbrowser-')
+        self.connection = sqlite3.connect(':memory:')
+        self.connection.execute(
+            "CREATE TABLE object_state (zoid INTEGER PRIMARY KEY, state)")
+        self.connection.executemany(
+            "INSERT INTO object_state (zoid) VALUES (?)",
+            [(oid, ) for oid in range(100)])
+        self.connection.commit()
+
+    def tearDown(self):
+        self.connection.close()
+        shutil.rmtree(self.tmpdir)
+
+    def remaining(self):
+        return [oid for oid, in self.connection.execute(
+            "SELECT zoid FROM object_state ORDER BY zoid")]
+
+    def test_run(self):
+        progress = []
+        executor = PackExecutor(
+            self.connection, batch_size=10, min_batch_size=10,
+            progress=lambda deleted, seconds: progress.append(deleted))
+        self.assertEqual(executor.run(range(1, 100, 2)), 50)
+        self.assertEqual(self.remaining(), range(0, 100, 2))
+        self.assertEqual(progress[-1], 50)
+
+    def test_adjustBatchSize(self):
+        executor = PackExecutor(self.connection, target_latency=1.0,
+                                batch_size=100, min_batch_size=10,
+                                max_batch_size=200)
+        executor.adjustBatchSize(1.25)
+        self.assertEqual(executor.batch_size, 80)
+        executor.adjustBatchSize(0.1)
+        self.assertEqual(executor.batch_size, 160)  # at most doubled
+        executor.adjustBatchSize(0)
+        self.assertEqual(executor.batch_size, 200)  # at most max_batch_size
+        executor.adjustBatchSize(5)
+        self.assertEqual(executor.batch_size, 100)  # at least halved
+        executor.batch_size = 15
+        executor.adjustBatchSize(2)
+        self.assertEqual(executor.batch_size, 10)  # at least min_batch_size
+
+    def test_batches_grow_when_fast(self):
+        # every clock() call moves time on by 0.25 seconds, so every batch
+        # seems to take 0.25 seconds
+        progress = []
+        executor = PackExecutor(
+            self.connection, target_latency=1.0, batch_size=10,
+            clock=ClockStub(0.25),
+            progress=lambda deleted, seconds: progress.append(deleted))
+        executor.run(range(100))
+        self.assertEqual(progress, [10, 30, 70, 100])
+
+    def test_resume(self):
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+
+        def interrupt(deleted, seconds):
+            raise Interrupted()
+
+        executor = PackExecutor(self.connection, batch_size=10,
+                                min_batch_size=10, checkpoint=checkpoint,
+                                source='0x01', progress=interrupt)
+        self.assertRaises(Interrupted, executor.run, range(100))
+        self.assertEqual(self.remaining(), range(10, 100))
+        self.assertEqual(open(checkpoint).read(), '9\n0x01\n')
+
+        executor = PackExecutor(self.connection, batch_size=10,
+                                min_batch_size=10, checkpoint=checkpoint,
+                                source='0x01')
+        # the first 10 are skipped
+        self.assertEqual(executor.run(range(100)), 90)
+        self.assertEqual(self.remaining(), [])
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_complete_run_starts_over(self):
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+        executor = PackExecutor(self.connection, batch_size=10,
+                                checkpoint=checkpoint)
+        self.assertEqual(executor.run(range(50, 100)), 50)
+        self.assertFalse(os.path.exists(checkpoint))
+
+        executor = PackExecutor(self.connection, batch_size=10,
+                                checkpoint=checkpoint)
+        # nothing is skipped, low oids included
+        self.assertEqual(executor.run(range(50)), 50)
+        self.assertEqual(self.remaining(), [])
+
+    def test_resume_refuses_other_source(self):
+        checkpoint = os.path.join(self.tmpdir, 'checkpoint')
+
+        def interrupt(deleted, seconds):
+            raise Interrupted()
+
+        executor = PackExecutor(self.connection, batch_size=10,
+                                checkpoint=checkpoint, source='0x01',
+                                progress=interrupt)
+        self.assertRaises(Interrupted, executor.run, range(100))
+
+        executor = PackExecutor(self.connection, batch_size=10,
+                                checkpoint=checkpoint, source='0x02')
+        self.assertRaises(ValueError, executor.run, range(100))
+        self.assertEqual(self.remaining(), range(10, 100))
+
+    def test_placeholders(self):
+        executor = PackExecutor(self.connection, paramstyle='pyformat')
+        self.assertEqual(executor.placeholder, '%s')
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
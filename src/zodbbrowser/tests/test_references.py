@@ -0,0 +1,219 @@
+import os
+import sqlite3
+import threading
+import unittest
+
+import transaction
+from persistent.mapping import PersistentMapping
+from ZODB.utils import p64, u64
+
+from zodbbrowser import references
+from zodbbrowser.references import ReferencesDatabase
+from zodbbrowser.references import iter_analyzed, iter_analyzed_parallel
+from zodbbrowser.tests.realdb import RealDatabaseTest
+
+
+class TestReferencesDatabase(RealDatabaseTest):
+
+    def setUp(self):
+        RealDatabaseTest.setUp(self)
+        root = self.conn.root()
+        self.a = root['a'] = PersistentMapping()
+        self.b = self.a['b'] = PersistentMapping()
+        transaction.commit()
+        self.refs = ReferencesDatabase(os.path.join(self.tmpdir, 'refs.db'))
+        self.refs.createDatabase()
+
+    def tearDown(self):
+        self.refs.close()
+        RealDatabaseTest.tearDown(self)
+
+    def records(self, start=None):
+        for t in self.storage.iterator(start=start):
+            for record in t:
+                yield record
+
+    def query(self, sql, *args):
+        connection = sqlite3.connect(self.refs.db_name)
+        try:
+            result = connection.execute(sql, args).fetchall()
+            connection.commit()
+        finally:
+            connection.close()
+        return result
+
+    def test_analyzeRecords(self):
+        rows = self.refs.analyzeRecords(self.records())
+        # two revisions of root, a and b, plus root -> a and a -> b
+        self.assertEqual(rows, 6)
+        self.assertEqual(self.refs.getForwardReferences(self.a._p_oid),
+                         set([u64(self.b._p_oid)]))
+        self.assertEqual(self.refs.getBackwardReferences(self.b._p_oid),
+                         set([u64(self.a._p_oid)]))
+        self.assertEqual(self.refs.getMissingOIDs(), set())
+
+    def test_analyzeRecords_in_batches(self):
+        progress = []
+        self.refs.analyzeRecords(
+            self.records(), batch_size=2,
+            progress=lambda rows, seconds: progress.append(rows))
+        self.assertEqual(progress, [3, 6])
+
+    def test_objects(self):
+        self.refs.analyzeRecords(self.records())
+        self.assertEqual(
+            self.query("SELECT oid, tid, name, size FROM objects"
+                       " JOIN classes USING (class_id) WHERE oid = ?",
+                       u64(self.b._p_oid)),
+            [(u64(self.b._p_oid), u64(self.b._p_serial),
+              'persistent.mapping.PersistentMapping',
+              len(self.storage.load(self.b._p_oid)[0]))])
+
+    def test_iter_analyzed_parallel(self):
+        self.assertEqual(list(iter_analyzed_parallel(self.records(), 2,
+                                                     chunk_size=1)),
+                         list(iter_analyzed(self.records())))
+
+    def test_analyzeRecords_in_parallel(self):
+        self.refs.analyzeRecords(self.records(), jobs=2)
+        self.assertEqual(
+            self.query("SELECT source_oid, target_oid FROM edges"),
+            [(0, u64(self.a._p_oid)),
+             (u64(self.a._p_oid), u64(self.b._p_oid))])
+
+    def test_updateRecords(self):
+        self.refs.analyzeRecords(self.records())
+        last_tid = self.storage.lastTransaction()
+        c = self.a['c'] = PersistentMapping()
+        del self.a['b']
+        transaction.commit()
+        rows = self.refs.updateRecords(
+            self.records(start=p64(u64(last_tid) + 1)))
+        # a and c, plus a -> c
+        self.assertEqual(rows, 3)
+        self.assertEqual(self.refs.getForwardReferences(self.a._p_oid),
+                         set([u64(c._p_oid)]))
+        self.assertEqual(self.refs.getBackwardReferences(self.b._p_oid),
+                         set())
+
+    def test_updateRecords_newest_revision_wins(self):
+        self.refs.analyzeRecords(self.records())
+        last_tid = self.storage.lastTransaction()
+        c = self.a['c'] = PersistentMapping()
+        transaction.commit()
+        del self.a['c']
+        transaction.commit()
+        self.refs.updateRecords(self.records(start=p64(u64(last_tid) + 1)),
+                                chunk_size=10)
+        self.assertEqual(self.refs.getForwardReferences(self.a._p_oid),
+                         set([u64(self.b._p_oid)]))
+
+    def test_last_transaction(self):
+        self.assertEqual(self.refs.getLastTransaction(), None)
+        self.refs.setLastTransaction(p64(42))
+        self.refs.setLastTransaction(p64(43))
+        self.assertEqual(self.refs.getLastTransaction(), p64(43))
+
+    def test_last_transaction_of_old_database(self):
+        refs = ReferencesDatabase(os.path.join(self.tmpdir, 'old.db'))
+        connection = sqlite3.connect(refs.db_name)
+        connection.execute("CREATE TABLE links"
+                           " (source_oid BIGINT, target_oid BIGINT)")
+        connection.close()
+        self.assertEqual(refs.getLastTransaction(), None)
+        refs.close()
+
+    def test_connection_is_kept_open(self):
+        self.refs.checkDatabase()
+        connection = self.refs._local.connection
+        self.refs.getMissingOIDs()
+        self.assertTrue(self.refs._local.connection is connection)
+
+    def test_connection_per_thread(self):
+        self.refs.checkDatabase()
+        connections = []
+
+        def run():
+            self.refs.checkDatabase()
+            connections.append(self.refs._local.connection)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        self.assertFalse(connections[0] is self.refs._local.connection)
+        self.assertEqual(len(self.refs._connections), 2)
+        self.refs.close()
+        self.assertEqual(self.refs._connections, [])
+        # and reopens when needed again
+        self.assertTrue(self.refs.checkDatabase())
+
+    def test_ingest_settings_are_restored(self):
+        self.refs.analyzeRecords(self.records())
+        connection = self.refs._local.connection
+        self.assertEqual(
+            connection.execute('PRAGMA journal_mode').fetchone()[0], 'delete')
+
+    def test_readonly(self):
+        self.refs.analyzeRecords(self.records())
+        refs = ReferencesDatabase(self.refs.db_name, readonly=True)
+        try:
+            self.assertEqual(refs.getForwardReferences(self.a._p_oid),
+                             set([u64(self.b._p_oid)]))
+            self.assertRaises(sqlite3.OperationalError,
+                              refs.setLastTransaction, p64(42))
+        finally:
+            refs.close()
+
+    def test_getUnUsedOIDs(self):
+        for oid in range(7):
+            self.query("INSERT INTO objects (oid) VALUES (?)", oid)
+        for link in [(0, 1), (1, 2), (2, 1), (3, 2), (4, 5), (5, 4),
+                     (5, 42)]:
+            self.query("INSERT INTO edges (source_oid, target_oid)"
+                       " VALUES (?, ?)", *link)
+        self.assertEqual(list(self.refs.getUnUsedOIDs()), [3, 4, 5, 6])
+        self.assertEqual(list(self.refs.getUnUsedOIDs(in_memory=True)),
+                         [3, 4, 5, 6])
+        self.assertEqual(self.refs.getMissingOIDs(), set([42]))
+
+    def test_getUnUsedOIDs_in_chunks(self):
+        for oid in range(6):
+            self.query("INSERT INTO objects (oid) VALUES (?)", oid)
+        fetch_size = references.FETCH_SIZE
+        references.FETCH_SIZE = 2
+        try:
+            self.assertEqual(list(self.refs.getUnUsedOIDs()), [1, 2, 3, 4, 5])
+        finally:
+            references.FETCH_SIZE = fetch_size
+
+    def test_indexes_created_after_loading(self):
+        self.refs.analyzeRecords(self.records())
+        self.assertEqual(
+            self.query("SELECT name FROM sqlite_master WHERE type = 'index'"
+                       " AND tbl_name = 'edges' ORDER BY name"),
+            [('edges_target_index', )])
+
+    def test_migrateDatabase(self):
+        refs = ReferencesDatabase(os.path.join(self.tmpdir, 'old.db'))
+        connection = sqlite3.connect(refs.db_name)
+        connection.execute("CREATE TABLE links"
+                           " (source_oid BIGINT, target_oid BIGINT)")
+        connection.executemany("INSERT INTO links VALUES (?, ?)",
+                               [(0, 1), (0, 1), (1, -1), (2, 3)])
+        connection.commit()
+        connection.close()
+        try:
+            self.assertTrue(refs.needsMigration())
+            self.assertFalse(refs.checkDatabase())
+            refs.migrateDatabase()
+            self.assertFalse(refs.needsMigration())
+            self.assertTrue(refs.checkDatabase())
+            self.assertEqual(refs.getForwardReferences(p64(0)), set([1]))
+            self.assertEqual(list(refs.getUnUsedOIDs()), [2])
+            self.assertEqual(refs.getMissingOIDs(), set([3]))
+        finally:
+            refs.close()
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,133 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+import ZODB.blob
+from ZODB.utils import p64
+
+from zodbbrowser.references import ReferencesDatabase
+from zodbbrowser.sqlpack import delete_statement, main
+from zodbbrowser.sqlpack import list_all_blobs_in, read_manifest
+
+
+def create_blobs(base_dir, oids):
+    helper = ZODB.blob.FilesystemHelper(base_dir)
+    helper.create()
+    paths = []
+    for oid in oids:
+        path = helper.layout.oid_to_path(p64(oid))
+        os.makedirs(os.path.join(base_dir, path))
+        open(os.path.join(base_dir, path, '0x01.blob'), 'w').close()
+        paths.append(path)
+    return helper.layout, paths
+
+
+class TestBlobs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-zodbbrowser-')
+        self.blobs = os.path.join(self.tmpdir, 'blobs')
+        self.layout, self.paths = create_blobs(self.blobs, [1, 2, 0x1234])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_list_all_blobs_in(self):
+        # FilesystemHelper.create() made a tmp directory
+        open(os.path.join(self.blobs, 'tmp', 'junk'), 'w').close()
+        blobs = list_all_blobs_in(self.blobs, self.layout, threads=2)
+        self.assertEqual(list(blobs), [1, 2, 0x1234])
+
+    def test_list_all_blobs_in_nothing(self):
+        self.assertEqual(len(list_all_blobs_in(None)), 0)
+
+    def test_read_manifest(self):
+        manifest = os.path.join(self.tmpdir, 'manifest')
+        with open(manifest, 'w') as f:
+            for path in self.paths:
+                f.write(os.path.join(path, '0x01.blob') + '\n')
+            f.write('\n')
+        blobs = read_manifest(manifest, self.layout)
+        self.assertEqual(list(blobs), [1, 2, 0x1234])
+
+
+class TestDeleteStatement(unittest.TestCase):
+
+    def test_one(self):
+        self.assertEqual(delete_statement([42]),
+                         'DELETE FROM object_state WHERE zoid = 42;\n')
+
+    def test_many(self):
+        self.assertEqual(
+            delete_statement([1, 2, 3]),
+            'DELETE FROM object_state WHERE zoid = ANY(ARRAY[1,2,3]);\n')
+
+
+class TestMain(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='test-zodbbrowser-')
+        self.refsdb = os.path.join(self.tmpdir, 'refs.db')
+        refs = ReferencesDatabase(self.refsdb)
+        refs.createDatabase()
+        connection = refs._connect()
+        connection.executemany("INSERT INTO objects (oid) VALUES (?)",
+                               [(oid, ) for oid in range(8)])
+        connection.commit()
+        connection.close()
+        refs.close()
+        self.output = os.path.join(self.tmpdir, 'pack')
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmpdir)
+
+    def run_sqlpack(self, *args):
+        main(['--references', self.refsdb, '--output', self.output] +
+             list(args))
+        todo = os.path.join(self.output, 'todo')
+        return [open(os.path.join(todo, filename)).read()
+                for filename in sorted(os.listdir(todo))]
+
+    def test_one_object_per_statement(self):
+        files = self.run_sqlpack('--lines', '4')
+        self.assertEqual(files, [
+            'BEGIN;\n' +
+            ''.join(delete_statement([oid]) for oid in [1, 2, 3, 4]) +
+            'COMMIT;\n',
+            'BEGIN;\n' +
+            ''.join(delete_statement([oid]) for oid in [5, 6, 7]) +
+            'COMMIT;\n',
+        ])
+
+    def test_blobs(self):
+        blobs = os.path.join(self.tmpdir, 'blobs')
+        layout, paths = create_blobs(blobs, [0, 3, 42])
+        self.run_sqlpack('--blobs', blobs)
+        shell = open(os.path.join(self.output, 'blobs.sh')).read()
+        self.assertEqual(shell.splitlines()[4:],
+                         ['rm -rf {}'.format(paths[1])])
+        self.assertEqual(sys.stdout.getvalue(),
+                         'Found 7 objects and 1 blobs.\n')
+
+    def test_statement_size(self):
+        files = self.run_sqlpack('--lines', '5', '--statement-size', '2')
+        self.assertEqual(files, [
+            'BEGIN;\n' +
+            delete_statement([1, 2]) +
+            delete_statement([3, 4]) +
+            delete_statement([5]) +
+            'COMMIT;\n',
+            'BEGIN;\n' +
+            delete_statement([6, 7]) +
+            'COMMIT;\n',
+        ])
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,75 @@
+import optparse
+import unittest
+
+from zodbbrowser import standalone
+from zodbbrowser.standalone import open_database, add_zeo_options
+
+
+class ClientStorageStub(object):
+
+    def __init__(self, addr, **kwargs):
+        self.addr = addr
+        self.kwargs = kwargs
+
+
+class TestOpenDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.parser = optparse.OptionParser()
+        self.parser.add_option('--config')
+        self.parser.add_option('--zeo')
+        self.parser.add_option('--storage')
+        self.parser.add_option('--db')
+        self.parser.add_option('--rw', action='store_false', dest='readonly',
+                               default=True)
+        add_zeo_options(self.parser)
+        self.opened = []
+        self._ClientStorage = standalone.ClientStorage
+        self._DB = standalone.DB
+        standalone.ClientStorage = ClientStorageStub
+        standalone.DB = self.opened.append
+
+    def tearDown(self):
+        standalone.ClientStorage = self._ClientStorage
+        standalone.DB = self._DB
+
+    def open(self, *args):
+        opts, args = self.parser.parse_args(list(args))
+        open_database(opts)
+        return self.opened[-1]
+
+    def test_zeo_defaults(self):
+        storage = self.open('--zeo', 'localhost:8100')
+        self.assertEqual(storage.addr, ('localhost', 8100))
+        self.assertEqual(storage.kwargs, {'storage': '1', 'read_only': True})
+
+    def test_zeo_cache_options(self):
+        storage = self.open('--zeo', 'localhost:8100',
+                            '--zeo-cache-size', '200',
+                            '--zeo-client', 'browser',
+                            '--zeo-var', '/var/cache/zodbbrowser')
+        self.assertEqual(storage.kwargs['cache_size'], 200 * 1024 * 1024)
+        self.assertEqual(storage.kwargs['client'], 'browser')
+        self.assertEqual(storage.kwargs['var'], '/var/cache/zodbbrowser')
+
+    def test_zeo_cache_options_without_zeo(self):
+        self.assertRaises(ValueError, self.open,
+                          '--db', 'Data.fs', '--zeo-cache-size', '200')
+        self.assertRaises(ValueError, self.open,
+                          '--db', 'Data.fs', '--zeo-client', 'browser')
+
+    def test_zeo_var_without_client(self):
+        self.assertRaises(ValueError, self.open,
+                          '--zeo', 'localhost:8100', '--zeo-var', '/tmp')
+
+    def test_options_without_zeo_cache_options(self):
+        # scripts that do not call add_zeo_options still work
+        opts = optparse.Values(dict(config=None, zeo='localhost:8100',
+                                    storage=None, db=None, readonly=True))
+        open_database(opts)
+        self.assertEqual(self.opened[-1].kwargs,
+                         {'storage': '1', 'read_only': True})
+
+
+def test_suite():
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -0,0 +1,78 @@
+import unittest
+import sys
+
+from ZODB.utils import p64
+
+from zodbbrowser.tidarray import TidArray, TidView
+
+
+class TestTidArray(unittest.TestCase):
+
+    def setUp(self):
+        self.tids = [p64(n) for n in range(10, 20)]
+        self.array = TidArray(self.tids)
+
+    def test_len(self):
+        self.assertEqual(len(TidArray()), 0)
+        self.assertEqual(len(self.array), 10)
+
+    def test_getitem(self):
+        self.assertEqual(self.array[0], p64(10))
+        self.assertEqual(self.array[-1], p64(19))
+        self.assertRaises(IndexError, self.array.__getitem__, 10)
+        self.assertRaises(IndexError, self.array.__getitem__, -11)
+
+    def test_iter(self):
+        self.assertEqual(list(self.array), self.tids)
+        self.assertEqual(tuple(self.array), tuple(self.tids))
+
+    def test_slicing(self):
+        view = self.array[2:5]
+        self.assertTrue(isinstance(view, TidView))
+        self.assertTrue(view._data is self.array._data)
+        self.assertEqual(list(view), self.tids[2:5])
+        self.assertEqual(list(view[1:]), self.tids[3:5])
+        self.assertEqual(list(self.array[-3:]), self.tids[-3:])
+        self.assertEqual(list(self.array[5:2]), [])
+        self.assertEqual(self.array[::3], self.tids[::3])
+
+    def test_index(self):
+        self.assertEqual(self.array.index(p64(10)), 0)
+        self.assertEqual(self.array.index(p64(17)), 7)
+        self.assertEqual(self.array[3:].index(p64(17)), 4)
+        self.assertRaises(ValueError, self.array.index, p64(5))
+        self.assertRaises(ValueError, self.array.index, p64(25))
+        self.assertRaises(ValueError, self.array[:3].index, p64(17))
+        self.assertTrue(p64(12) in self.array)
+        self.assertFalse(p64(12) in self.array[3:])
+
+    def test_extend_keeps_views_unchanged(self):
+        view = self.array.view()
+        self.array.extend([p64(20), p64(21)])
+        self.array.append(p64(22))
+        self.assertEqual(len(view), 10)
+        self.assertEqual(len(self.array), 13)
+        self.assertEqual(self.array[-1], p64(22))
+        self.assertEqual(list(view), self.tids)
+
+    def test_extend_bad_tid(self):
+        self.assertRaises(ValueError, self.array.extend, ['short'])
+
+    def test_failed_extend_leaves_array_usable(self):
+        # 7 + 9 bytes add up to two tids' worth, but are not two tids
+        self.assertRaises(ValueError, self.array.extend,
+                          [p64(30), 'x' * 7, 'y' * 9])
+        self.assertEqual(list(self.array), self.tids)
+        self.array.append(p64(31))
+        self.assertEqual(self.array[-1], p64(31))
+        self.assertEqual(len(self.array), len(self.tids) + 1)
+
+    def test_equality(self):
+        self.assertEqual(self.array, TidArray(self.tids))
+        self.assertEqual(self.array[:2], TidArray(self.tids[:2]))
+        self.assertNotEqual(self.array, self.array[:2])
+
+
+def test_suite():
+    this = sys.modules[__name__]
+    return unittest.defaultTestLoader.loadTestsFromModule(this)
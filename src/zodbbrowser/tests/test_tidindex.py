@@ -0,0 +1,115 @@
+import unittest
+import os
+import sys
+import time
+
+import transaction
+from persistent.dict import PersistentDict
+from ZODB.serialize import referencesf
+
+from zodbbrowser.tests.realdb import RealDatabaseTest
+from zodbbrowser.tidindex import TransactionIndex, MAGIC, ENTRY_SIZE
+
+
+class TestTransactionIndex(RealDatabaseTest):
+
+    def setUp(self):
+        RealDatabaseTest.setUp(self)
+        self.obj = self.conn.root()['obj'] = PersistentDict()
+        transaction.commit()
+        self.commitSome(5)
+
+    def commitSome(self, n):
+        for i in range(n):
+            self.obj[i] = i
+            transaction.commit()
+
+    def contents(self, index):
+        return list(index.tids), list(index.positions)
+
+    def expected(self):
+        return ([t.tid for t in self.storage.iterator()],
+                [t._tpos for t in self.storage.iterator()])
+
+    def test_build(self):
+        index = TransactionIndex(self.storage)
+        index.update()
+        self.assertEqual(self.contents(index), self.expected())
+        self.assertEqual(len(index), 7)
+        self.assertEqual(os.path.getsize(index.filename),
+                         len(MAGIC) + 7 * ENTRY_SIZE)
+
+    def test_reuse_sidecar_file(self):
+        TransactionIndex(self.storage).update()
+        index = TransactionIndex(self.storage)
+        index._scan = lambda tids, positions: ([], [])
+        index.update()
+        self.assertEqual(self.contents(index), self.expected())
+
+    def test_incremental_update(self):
+        index = TransactionIndex(self.storage)
+        index.update()
+        self.commitSome(3)
+        index.update()
+        self.assertEqual(self.contents(index), self.expected())
+        index = TransactionIndex(self.storage)
+        index.update()
+        self.assertEqual(self.contents(index), self.expected())
+
+    def test_partial_entry_ignored(self):
+        index = TransactionIndex(self.storage)
+        index.update()
+        with open(index.filename, 'ab') as f:
+            f.write('garbage')
+        index = TransactionIndex(self.storage)
+        index.update()
+        self.assertEqual(self.contents(index), self.expected())
+        self.assertEqual(os.path.getsize(index.filename),
+                         len(MAGIC) + 7 * ENTRY_SIZE)
+
+    def test_bad_sidecar_file(self):
+        index = TransactionIndex(self.storage)
+        with open(index.filename, 'wb') as f:
+            f.write('this is not an index')
+        index.update()
+        self.assertEqual(self.contents(index), self.expected())
+
+    def test_rebuild_after_pack(self):
+        index = TransactionIndex(self.storage)
+        index.update()
+        self.storage.pack(time.time(), referencesf)
+        index.update()
+        self.assertEqual(self.contents(index), self.expected())
+
+    def test_unwritable_sidecar_file(self):
+        index = TransactionIndex(self.storage,
+                                 os.path.join(self.tmpdir, 'nosuchdir', 'x'))
+        index.update()
+        self.assertEqual(self.contents(index), self.expected())
+        self.commitSome(1)
+        index.update()
+        self.assertEqual(self.contents(index), self.expected())
+
+    def test_iterator(self):
+        index = TransactionIndex(self.storage)
+        index.update()
+        tids = self.expected()[0]
+        self.assertEqual([t.tid for t in index.iterator(tids[2], tids[4])],
+                         tids[2:5])
+        self.assertEqual([t.tid for t in index.iterator(tids[0], tids[6])],
+                         tids)
+        self.assertEqual([t.tid for t in index.iterator(tids[6], tids[6])],
+                         tids[6:])
+
+    def test_iterator_unindexed_tid(self):
+        index = TransactionIndex(self.storage)
+        index.update()
+        self.commitSome(2)
+        tids = self.expected()[0]
+        self.assertEqual([t.tid for t in index.iterator(tids[7], tids[8])],
+                         tids[7:])
+
+
+def test_suite():
+    this = sys.modules[__name__]
+    return unittest.defaultTestLoader.loadTestsFromModule(this)
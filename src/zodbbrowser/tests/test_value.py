@@ -13,7 +13,8 @@ from zodbbrowser.value import (GenericValue, TupleValue, ListValue, DictValue,
                                PersistentValue, ProvidesValue, StringValue,
                                MAX_CACHE_SIZE,
                                TRUNCATIONS, TRUNCATIONS_IN_ORDER, truncate,
-                               resetTruncations, pruneTruncations)
+                               resetTruncations, pruneTruncations,
+                               hasExpiredTruncations, findPersistentValues)
 
 
 class OldStyle:
@@ -107,6 +108,28 @@ class TestTruncations(unittest.TestCase):
         self.assertEquals(sorted(TRUNCATIONS_IN_ORDER), sorted(TRUNCATIONS))
         self.assertEquals(TRUNCATIONS_IN_ORDER[0], 'tr4')
 
+    def test_hasExpiredTruncations(self):
+        html = 'x<span id="%s" class="truncated">...</span>' % truncate('x')
+        self.assertFalse(hasExpiredTruncations(html))
+        self.assertFalse(hasExpiredTruncations('no truncations'))
+        resetTruncations()
+        self.assertTrue(hasExpiredTruncations(html))
+
+
+class TestFindPersistentValues(unittest.TestCase):
+
+    def test(self):
+        a, b, c, d = [PersistentFrob() for n in range(4)]
+        nested = [1, (a, 'x'), {b: {'k': [c]}}, set([d]), a]
+        self.assertEquals(sorted(findPersistentValues(nested)),
+                          sorted([a, b, c, d]))
+
+    def test_cycles(self):
+        a = PersistentFrob()
+        loop = [a]
+        loop.append(loop)
+        self.assertEquals(findPersistentValues([loop]), [a])
+
 
 class TestGenericValue(unittest.TestCase):
 
@@ -0,0 +1,102 @@
+"""
+Compact sequences of transaction ids.
+"""
+
+import bisect
+
+
+TID_SIZE = 8
+
+
+class TidView(object):
+    """Read-only sequence of transaction ids.
+
+    All the tids are kept in one contiguous buffer, 8 bytes each, instead of
+    a list of separate string objects.  Slicing returns another view of the
+    same buffer without copying anything.  Tids are expected to be sorted,
+    which lets index() use a binary search.
+    """
+
+    def __init__(self, data, start, stop):
+        self._data = data
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step != 1:
+                return [self[n] for n in xrange(start, stop, step)]
+            stop = max(start, stop)
+            return TidView(self._data, self._start + start,
+                           self._start + stop)
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError(item)
+        offset = (self._start + item) * TID_SIZE
+        return str(self._data[offset:offset + TID_SIZE])
+
+    def __iter__(self):
+        data = self._data
+        for offset in xrange(self._start * TID_SIZE, self._stop * TID_SIZE,
+                             TID_SIZE):
+            yield str(data[offset:offset + TID_SIZE])
+
+    def __eq__(self, other):
+        if isinstance(other, TidView):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return '<%s of %d tids>' % (self.__class__.__name__, len(self))
+
+    def index(self, tid):
+        pos = bisect.bisect_left(self, tid)
+        if pos < len(self) and self[pos] == tid:
+            return pos
+        raise ValueError('%r is not in the list' % tid)
+
+    def __contains__(self, tid):
+        try:
+            self.index(tid)
+        except ValueError:
+            return False
+        return True
+
+
+class TidArray(TidView):
+    """Growable sequence of transaction ids.
+
+    Views taken before an extend() keep seeing the old length, which makes
+    them cheap consistent snapshots.
+    """
+
+    def __init__(self, tids=()):
+        TidView.__init__(self, bytearray(), 0, 0)
+        self.extend(tids)
+
+    def append(self, tid):
+        self.extend([tid])
+
+    def extend(self, tids):
+        assert self._stop * TID_SIZE == len(self._data)
+        tids = list(tids)
+        for tid in tids:
+            if len(tid) != TID_SIZE:
+                raise ValueError('tids must be %d bytes long' % TID_SIZE)
+        self._data.extend(''.join(tids))
+        self._stop = len(self._data) // TID_SIZE
+
+    def view(self):
+        """Return a read-only snapshot of the current contents."""
+        return TidView(self._data, self._start, self._stop)
@@ -0,0 +1,188 @@
+"""
+On-disk index of transaction positions in a FileStorage.
+
+storage.iterator() always reads from the beginning of the file (or scans
+linearly to find the start tid), so paging through the history of a large
+Data.fs is painfully slow.  We keep a sidecar file next to the Data.fs that
+maps every transaction id to the byte offset of its transaction record.  It
+is built once, then extended incrementally from the last indexed record.
+
+The sidecar file consists of a short header followed by fixed-size entries,
+each entry being an 8-byte tid and an 8-byte big-endian file offset.
+"""
+
+import logging
+import threading
+from array import array
+
+from ZODB.FileStorage.FileStorage import FileIterator
+from ZODB.utils import p64, u64
+
+from zodbbrowser.tidarray import TidArray
+
+
+log = logging.getLogger(__name__)
+
+
+MAGIC = 'ZBTIDX01'
+ENTRY_SIZE = 16
+SUFFIX = '.tidx'
+
+# File offsets need 64 bits; 'L' is that wide on most 64-bit platforms,
+# otherwise fall back to doubles, which are exact up to 2**53.
+POSITION_TYPECODE = 'L' if array('L').itemsize >= 8 else 'd'
+
+
+class TransactionIndex(object):
+    """Index of transaction record positions in a FileStorage file."""
+
+    def __init__(self, storage, filename=None):
+        self._file_name = storage._file_name
+        if filename is None:
+            filename = self._file_name + SUFFIX
+        self.filename = filename
+        self._arrays = (TidArray(), array(POSITION_TYPECODE))
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._writable = True
+
+    @property
+    def tids(self):
+        return self._arrays[0]
+
+    @property
+    def positions(self):
+        return self._arrays[1]
+
+    def __len__(self):
+        return len(self.tids)
+
+    def update(self):
+        """Bring the index up to date with the storage file.
+
+        Reads the sidecar file on first use, discards it if the Data.fs was
+        packed or replaced, and then indexes transactions appended since the
+        last indexed one.
+
+        Concurrent readers keep seeing a consistent index: new entries are
+        appended in place, and a rebuilt index replaces the old one only when
+        it is complete.
+        """
+        with self._lock:
+            if not self._loaded:
+                if not self._read():
+                    self._rewrite()
+                self._loaded = True
+            tids, positions = self._arrays
+            if not self._valid():
+                log.info('Rebuilding transaction index %s', self.filename)
+                tids = TidArray()
+                positions = array(POSITION_TYPECODE)
+                self._write('wb', MAGIC)
+            new_tids, new_positions = self._scan(tids, positions)
+            if new_tids:
+                self._append(new_tids, new_positions)
+                # positions first, so that every visible tid has a position
+                positions.extend(new_positions)
+                tids.extend(new_tids)
+            self._arrays = (tids, positions)
+
+    def iterator(self, start, stop):
+        """Iterate over transactions from tid start to tid stop.
+
+        Seeks directly to the transaction record instead of scanning the file.
+        """
+        tids, positions = self._arrays
+        try:
+            pos = int(positions[tids.index(start)])
+        except ValueError:
+            # not indexed (any more?), let FileIterator look for it
+            pos = 4
+        return FileIterator(self._file_name, start, stop, pos=pos)
+
+    def _read(self):
+        """Load the sidecar file.
+
+        Returns False if the file is missing or damaged and needs to be
+        rewritten.
+        """
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return False
+        if not data.startswith(MAGIC):
+            log.warning('Ignoring bad transaction index %s', self.filename)
+            return False
+        # a partially written entry at the end is ignored
+        end = len(data) - (len(data) - len(MAGIC)) % ENTRY_SIZE
+        offsets = xrange(len(MAGIC), end, ENTRY_SIZE)
+        tids, positions = self._arrays
+        positions.extend(u64(data[offset + 8:offset + ENTRY_SIZE])
+                         for offset in offsets)
+        tids.extend(data[offset:offset + 8] for offset in offsets)
+        return end == len(data)
+
+    def _valid(self):
+        """Check that the indexed positions still match the storage file.
+
+        Packing rewrites the file, so we probe the first and the last indexed
+        transaction records; this is cheap and catches both packing and
+        outright replacement of the Data.fs.
+        """
+        tids, positions = self._arrays
+        if not tids:
+            return True
+        try:
+            with open(self._file_name, 'rb') as f:
+                for n in (0, -1):
+                    f.seek(int(positions[n]))
+                    if f.read(8) != tids[n]:
+                        return False
+        except IOError:
+            return False
+        return True
+
+    def _scan(self, tids, positions):
+        if positions:
+            last_tid = tids[-1]
+            it = FileIterator(self._file_name, pos=int(positions[-1]))
+        else:
+            last_tid = None
+            it = FileIterator(self._file_name)
+        new_tids = []
+        new_positions = []
+        try:
+            for t in it:
+                if t.tid == last_tid:
+                    continue
+                new_tids.append(t.tid)
+                new_positions.append(t._tpos)
+        finally:
+            it.close()
+        return new_tids, new_positions
+
+    def _rewrite(self):
+        tids, positions = self._arrays
+        self._write('wb', MAGIC + self._pack(tids, positions))
+
+    def _append(self, tids, positions):
+        self._write('ab', self._pack(tids, positions))
+
+    def _pack(self, tids, positions):
+        return ''.join(tid + p64(int(pos))
+                       for tid, pos in zip(tids, positions))
+
+    def _write(self, mode, data):
+        # The index is only an optimization: if we cannot write it (e.g.
+        # because the Data.fs lives in a read-only directory) we keep it
+        # in memory.
+        if not self._writable:
+            return
+        try:
+            with open(self.filename, mode) as f:
+                f.write(data)
+        except IOError as e:
+            log.warning('Cannot write transaction index %s: %s',
+                        self.filename, e)
+            self._writable = False
@@ -15,7 +15,7 @@ from zope.interface import implements, Interface
 from zope.security.proxy import removeSecurityProxy
 
 from zodbbrowser.interfaces import IValueRenderer
-from zodbbrowser.interfaces import IObjectHistory
+from zodbbrowser.history import getObjectHistory, isPinnedAt
 
 
 log = logging.getLogger(__name__)
@@ -25,6 +25,7 @@ MAX_CACHE_SIZE = 1000
 TRUNCATIONS = {}
 TRUNCATIONS_IN_ORDER = collections.deque()
 next_id = itertools.count(1).next
+TRUNCATION_IDS = re.compile(r'<span id="(tr[0-9]+)" class="truncated">')
 
 
 def resetTruncations(): # for tests only!
@@ -39,6 +40,11 @@ def pruneTruncations():
         del TRUNCATIONS[TRUNCATIONS_IN_ORDER.popleft()]
 
 
+def hasExpiredTruncations(html):
+    """Check whether html refers to truncated values we no longer have."""
+    return any(id not in TRUNCATIONS for id in TRUNCATION_IDS.findall(html))
+
+
 def truncate(text):
     id = 'tr%d' % next_id()
     TRUNCATIONS[id] = text
@@ -210,6 +216,30 @@ class DictValue(object):
             return join_with_commas(html, '{', '}')
 
 
+def findPersistentValues(values):
+    """Find the persistent objects that rendering values would link to.
+
+    Looks inside tuples, lists, sets and dicts, but not inside persistent
+    objects.
+    """
+    result = []
+    seen = set()
+    queue = list(values)
+    while queue:
+        value = removeSecurityProxy(queue.pop())
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        if isinstance(value, Persistent):
+            result.append(value)
+        elif isinstance(value, (tuple, list, set, frozenset)):
+            queue.extend(value)
+        elif isinstance(value, dict):
+            queue.extend(value.keys())
+            queue.extend(value.values())
+    return result
+
+
 class PersistentValue(object):
     """Persistent object renderer.
 
@@ -229,8 +259,11 @@ class PersistentValue(object):
         url = '%s?oid=0x%x' % (self.view_name, u64(self.context._p_oid))
         if tid is not None:
             url += "&tid=%d" % u64(tid)
+        if tid is not None and not isPinnedAt(self.context._p_jar, tid):
+            # a historical connection opened at tid would give us the old
+            # state directly; otherwise we have to dig it up
             try:
-                oldstate = IObjectHistory(self.context).loadState(tid)
+                oldstate = getObjectHistory(self.context).loadState(tid)
                 clone = self.context.__class__.__new__(self.context.__class__)
                 clone.__setstate__(oldstate)
                 clone._p_oid = self.context._p_oid